@@ -18,6 +18,7 @@ class A3CDiscreteTrainer(FFDiscrete):
         FFDiscrete.__init__(self, sess, args)
         self.sess = sess
         self.config = args['config']
+        self.run_id = args['run_id']
         self.env = args['environment']
         self.timesteps_per_launch = args['max_pathlength']
         self.n_workers = args['n_workers']
@@ -30,6 +31,20 @@ class A3CDiscreteTrainer(FFDiscrete):
         self.gamma = args['gamma']
         self.save_every = args.get('save_every', 1)
         self.test_every = args.get('test_every', 10)
+        self.parameter_server = args.get('parameter_server', False)
+        self.accumulate_segments = args.get('accumulate_segments', 1)
+        self.gradient_compression = args.get('gradient_compression', None)
+        self.topk_fraction = args.get('topk_fraction', 0.01)
+        self.pull_every_versions = args.get('pull_every_versions', 1)
+        self.accumulated_gradients = None
+        self.accumulated_segments = 0
+        self.gradient_residuals = None
+        self.weights_version = -1
+        self.hogwild = args.get('hogwild', False)
+        self.shared_parameters = None
+        self.synchronous = args.get('synchronous', False)
+        self.n_envs = args.get('n_envs', 1)
+        self.env_config = {key: args.get(key) for key in ['env_type', 'env_name', 'continuous']}
 
         self.sums = self.sumsqrs = self.sumtime = 0
         self.timestep = 0
@@ -50,23 +65,19 @@ class A3CDiscreteTrainer(FFDiscrete):
         for i in range(len(self.n_actions)):
             self.targets["action_{}".format(i)] = tf.placeholder(dtype=tf.int32, shape=[None])
 
+        # action heads are independent, so the entropy of the joint distribution is a sum of per-head entropies
         N = tf.shape(self.targets["advantage"])[0]
-        base = [N] + [1 for _ in range(len(self.n_actions))]
-        log_dist = tf.zeros(shape=[N] + self.n_actions)
         p_n = tf.zeros(shape=[N])
+        entropy_n = tf.zeros(shape=[N])
         for i, n in enumerate(self.n_actions):
-            right_shape = base[:]
-            right_shape[i + 1] = n
             actions = self.targets["action_{}".format(i)]
-            action_log_dist = tf.reshape(self.action_logprobs[i], [-1])
-            p = tf.reshape(tf.gather(action_log_dist, tf.range(0, N) * n + actions), [-1])
+            log_dist = self.action_logprobs[i]
+            p = tf.gather(tf.reshape(log_dist, [-1]), tf.range(0, N) * n + actions)
             p_n += p
-            log_dist += tf.reshape(action_log_dist, right_shape)
-
-        N = tf.cast(N, tf.float32)
+            entropy_n += tf.reduce_sum(-tf.exp(log_dist) * log_dist, axis=1)
 
         self.loss = -tf.reduce_mean(p_n * self.targets["advantage"])
-        self.entropy = tf.reduce_sum(-tf.exp(log_dist) * log_dist) / N
+        self.entropy = tf.reduce_mean(entropy_n)
 
         value_loss = tf.reduce_mean((self.targets["return"] - self.value) ** 2)
 
@@ -140,6 +151,82 @@ class A3CDiscreteTrainer(FFDiscrete):
             variables_server.set('weight_{}'.format(i), hlp.dump_object(new_weight))
         return update_steps
 
+    def map_shared_parameters(self, mode='r+'):
+        if self.shared_parameters is None:
+            shapes = [hlp.var_shape(weight) for weight in self.weights]
+            arrays = hlp.shared_arrays('srlf_{}_{}'.format(self.config[:-5], self.run_id),
+                                       shapes + hlp.Adam.state_shapes(shapes), mode)
+            optimizer = hlp.Adam(shapes, self.learning_rate, state=arrays[len(shapes):])
+            self.shared_parameters = arrays[:len(shapes)], optimizer
+        return self.shared_parameters
+
+    def pull_weights(self, variables_server):
+        if self.hogwild:
+            weights, _ = self.map_shared_parameters()
+            return weights
+        if self.parameter_server:
+            self.weights_version, weights = hlp.load_object(variables_server.get('weights'))
+            return weights
+        return [hlp.load_object(variables_server.get("weight_{}".format(i))) for i in range(len(self.weights))]
+
+    def publish_weights(self, variables_server, weights, version):
+        pipe = variables_server.pipeline()
+        pipe.set('weights', hlp.dump_object([version, weights]))
+        pipe.set('weights_version', version)
+        pipe.execute()
+
+    def sync_weights(self, variables_server):
+        if self.parameter_server and not self.hogwild:
+            version = int(variables_server.get('weights_version'))
+            if version - self.weights_version < self.pull_every_versions:
+                return
+        self.set_weights(self.pull_weights(variables_server))
+
+    def push_gradients(self, variables_server, gradients):
+        # returns False while the gradients are only accumulated locally
+        if self.accumulated_gradients is None:
+            self.accumulated_gradients = [gradient.copy() for gradient in gradients]
+        else:
+            for accumulated, gradient in zip(self.accumulated_gradients, gradients):
+                accumulated += gradient
+        self.accumulated_segments += 1
+        if self.accumulated_segments < self.accumulate_segments:
+            return False
+        gradients = [accumulated / self.accumulated_segments for accumulated in self.accumulated_gradients]
+        self.accumulated_gradients = None
+        self.accumulated_segments = 0
+
+        if self.hogwild:
+            # lock-free in-place update of the shared parameters and Adam moments
+            weights, optimizer = self.map_shared_parameters()
+            optimizer(weights, gradients)
+        elif self.parameter_server:
+            if self.gradient_compression is not None:
+                if self.gradient_residuals is None:
+                    self.gradient_residuals = [np.zeros_like(gradient) for gradient in gradients]
+                gradients = hlp.compress_gradients(gradients, self.gradient_residuals, self.gradient_compression,
+                                                   self.topk_fraction)
+            variables_server.lpush('gradients', hlp.dump_object(gradients))
+        else:
+            self.apply_adam_updates(variables_server, gradients, self.learning_rate)
+        return True
+
+    def serve_parameters(self):
+        variables_server = Redis(port=12000)
+        weights = self.pull_weights(variables_server)
+        shapes = [weight.shape for weight in weights]
+        optimizer = hlp.Adam(shapes, self.learning_rate)
+        while True:
+            messages = [variables_server.brpop('gradients')[1]]
+            while True:
+                message = variables_server.rpop('gradients')
+                if message is None:
+                    break
+                messages.append(message)
+            for message in messages:
+                version = optimizer(weights, hlp.decompress_gradients(hlp.load_object(message), shapes))
+            self.publish_weights(variables_server, weights, version)
+
     def work(self):
         variables_server = Redis(port=12000)
         if self.scale != 'off':
@@ -150,9 +237,7 @@ class A3CDiscreteTrainer(FFDiscrete):
             except:
                 pass
         try:
-            weights = [hlp.load_object(variables_server.get("weight_{}".format(i))) for i in
-                       range(len(self.weights))]
-            self.set_weights(weights)
+            self.set_weights(self.pull_weights(variables_server))
         except:
             pass
         env = self.env
@@ -192,10 +277,59 @@ class A3CDiscreteTrainer(FFDiscrete):
             feed_dict[self.targets["advantage"]] = returns_batch - values
             feed_dict[self.targets["return"]] = returns_batch
             gradients = self.sess.run(self.gradients, feed_dict)
-            self.apply_adam_updates(variables_server, gradients, self.learning_rate)
-            weights = [hlp.load_object(variables_server.get("weight_{}".format(i))) for i in
-                       range(len(self.weights))]
-            self.set_weights(weights)
+            if self.push_gradients(variables_server, gradients) or self.parameter_server:
+                self.sync_weights(variables_server)
+
+    def work_synchronous(self):
+        variables_server = Redis(port=12000)
+        if self.scale != 'off':
+            try:
+                means = hlp.load_object(variables_server.get("means"))
+                stds = hlp.load_object(variables_server.get("stds"))
+                self.sess.run(self.norm_set_op, feed_dict=dict(zip(self.norm_phs, [means, stds])))
+            except:
+                pass
+        self.set_weights(self.pull_weights(variables_server))
+        envs = [self.env] + [hlp.env_from_config(self.env_config) for _ in range(self.n_envs - 1)]
+
+        while True:
+            observations, action_tuples = [], []
+            rewards = np.zeros((self.n_steps, self.n_envs))
+            terminals = np.zeros((self.n_steps, self.n_envs))
+            timestamps = np.zeros((self.n_steps + 1, self.n_envs))
+            for step in range(self.n_steps):
+                timestamps[step] = [env.timestamp for env in envs]
+                features = np.concatenate([env.features for env in envs], axis=0)
+                actions = self.act_batch(features)
+                observations.append(features)
+                action_tuples.append(actions)
+                for k, env in enumerate(envs):
+                    env.step(actions[k])
+                    rewards[step, k] = env.reward
+                    if env.done or env.timestamp > self.timesteps_per_launch:
+                        terminals[step, k] = 1
+                        variables_server.lpush('results', hlp.dump_object(env.get_total_reward()))
+                        print("Episode reward: {}".format(env.get_total_reward()), "Length: {}".format(env.timestamp))
+                        env.reset()
+
+            timestamps[-1] = [env.timestamp for env in envs]
+            features = np.concatenate([env.features for env in envs], axis=0)
+            bootstrap_values = self.sess.run(self.value, feed_dict={self.state_input: features})
+            returns_batch = hlp.discount_batch(rewards, terminals, bootstrap_values, self.gamma,
+                                               timestamps).reshape(-1)
+
+            observations_batch = np.concatenate(observations, axis=0)
+            actions_batch = np.concatenate(action_tuples, axis=0)
+
+            feed_dict = {self.state_input: observations_batch}
+            for i in range(len(self.n_actions)):
+                feed_dict[self.targets["action_{}".format(i)]] = actions_batch[:, i]
+            values = self.sess.run(self.value, feed_dict)
+            feed_dict[self.targets["advantage"]] = returns_batch - values
+            feed_dict[self.targets["return"]] = returns_batch
+            gradients = self.sess.run(self.gradients, feed_dict)
+            if self.push_gradients(variables_server, gradients) or self.parameter_server:
+                self.sync_weights(variables_server)
 
     def make_rollout(self):
         variables_server = Redis(port=12000)
@@ -207,9 +341,7 @@ class A3CDiscreteTrainer(FFDiscrete):
             except:
                 pass
         try:
-            weights = [hlp.load_object(variables_server.get("weight_{}".format(i))) for i in
-                       range(len(self.weights))]
-            self.set_weights(weights)
+            self.set_weights(self.pull_weights(variables_server))
         except:
             pass
         env = self.env
@@ -218,48 +350,35 @@ class A3CDiscreteTrainer(FFDiscrete):
         timestep = 0
         i_task = 0
 
-        paths = []
+        buffer = hlp.RolloutBuffer(n_tasks * self.timesteps_per_launch, env.get_observation_space(),
+                                   len(self.n_actions), sum(self.n_actions), np.int32)
         while i_task < n_tasks:
-            path = {}
-            observations, action_tuples, rewards, dist_tuples, timestamps = [], [], [], [], []
-            sums = np.zeros((1, env.get_observation_space()))
-            sumsqrs = np.zeros(sums.shape)
-
             env.reset()
             while not env.done and env.timestamp < self.timesteps_per_launch:
-                sums += env.features
-                sumsqrs += np.square(env.features)
-                observations.append(env.features[0])
-                timestamps.append(env.timestamp)
+                features = env.features
+                timestamp = env.timestamp
 
+                dist_tuple = None
                 if not self.test_mode:
                     actions, dist_tuple = self.act(env.features, return_dists=True)
-                    dist_tuples.append(dist_tuple)
                 else:
                     actions = self.act(env.features, exploration=False)
                 env.step(actions)
                 timestep += 1
 
-                action_tuples.append(actions)
-                rewards.append(env.reward)
+                buffer.add(features, actions, env.reward, timestamp, dist_tuple)
 
-            path["observations"] = np.array(observations)
-            path["action_tuples"] = np.array(action_tuples)
-            path["rewards"] = np.array(rewards)
-            if not self.test_mode:
-                path["dist_tuples"] = np.array(dist_tuples)
-            path["timestamps"] = np.array(timestamps)
-            path["sumobs"] = sums
-            path["sumsqrobs"] = sumsqrs
-            path["terminated"] = env.done
-            path["total"] = env.get_total_reward()
-            paths.append(path)
+            buffer.end_episode(env.done, env.get_total_reward())
             i_task += 1
 
         if self.distributed:
-            variables_server.set("paths_{}".format(self.id_worker), hlp.dump_object(paths))
+            variables_server.set("rollout_{}".format(self.id_worker), hlp.dump_object(buffer.record()))
         else:
-            self.paths = paths
+            self.rollout = buffer.record()
+
+    def collect_rollouts(self):
+        return hlp.merge_rollouts([hlp.load_object(self.variables_server.get("rollout_{}".format(i)))
+                                   for i in range(self.n_workers)])
 
     def train(self):
         cmd_server = 'redis-server --port 12000'
@@ -275,20 +394,18 @@ class A3CDiscreteTrainer(FFDiscrete):
                         {
                             'config': self.config,
                             'test_mode': False,
+                            'run_id': self.run_id,
                         }
                     hlp.launch_workers(worker_args, self.n_workers)
-                    paths = []
-                    for i in range(self.n_workers):
-                        paths += hlp.load_object(self.variables_server.get("paths_{}".format(i)))
+                    rollout = self.collect_rollouts()
                 else:
                     self.test_mode = False
                     self.make_rollout()
-                    paths = self.paths
+                    rollout = self.rollout
 
-                for path in paths:
-                    self.sums += path["sumobs"]
-                    self.sumsqrs += path["sumsqrobs"]
-                    self.sumtime += path["observations"].shape[0]
+                self.sums += rollout["sumobs"]
+                self.sumsqrs += rollout["sumsqrobs"]
+                self.sumtime += rollout["observations"].shape[0]
 
             stds = np.sqrt((self.sumsqrs - np.square(self.sums) / self.sumtime) / (self.sumtime - 1))
             means = self.sums / self.sumtime
@@ -298,19 +415,32 @@ class A3CDiscreteTrainer(FFDiscrete):
             self.variables_server.set("stds", hlp.dump_object(stds))
             self.sess.run(self.norm_set_op, feed_dict=dict(zip(self.norm_phs, [means, stds])))
 
-        weights = self.get_weights()
-        for i, weight in enumerate(weights):
-            self.variables_server.set("weight_" + str(i), hlp.dump_object(weight))
-            self.variables_server.set('momentum_{}'.format(i), hlp.dump_object(np.zeros(weight.shape)))
-            self.variables_server.set('velocity_{}'.format(i), hlp.dump_object(np.zeros(weight.shape)))
-        self.variables_server.set('update_steps', hlp.dump_object(0))
-
         worker_args = \
             {
                 'config': self.config,
                 'test_mode': False,
+                'run_id': self.run_id,
             }
-        hlp.launch_workers(worker_args, self.n_workers, command='work', wait=False)
+        weights = self.get_weights()
+        if self.hogwild:
+            shared_weights, _ = self.map_shared_parameters(mode='w+')
+            for shared_weight, weight in zip(shared_weights, weights):
+                shared_weight[:] = weight
+        elif self.parameter_server:
+            self.variables_server.delete('gradients')
+            self.publish_weights(self.variables_server, weights, 0)
+            hlp.launch_workers(worker_args, 1, command='serve_parameters', wait=False)
+        else:
+            for i, weight in enumerate(weights):
+                self.variables_server.set("weight_" + str(i), hlp.dump_object(weight))
+                self.variables_server.set('momentum_{}'.format(i), hlp.dump_object(np.zeros(weight.shape)))
+                self.variables_server.set('velocity_{}'.format(i), hlp.dump_object(np.zeros(weight.shape)))
+            self.variables_server.set('update_steps', hlp.dump_object(0))
+
+        if self.synchronous:
+            hlp.launch_workers(worker_args, 1, command='work_synchronous', wait=False)
+        else:
+            hlp.launch_workers(worker_args, self.n_workers, command='work', wait=False)
 
         while True:
             time.sleep(self.test_every)
@@ -320,18 +450,17 @@ class A3CDiscreteTrainer(FFDiscrete):
                     {
                         'config': self.config,
                         'test_mode': True,
+                        'run_id': self.run_id,
                     }
                 hlp.launch_workers(worker_args, self.n_workers)
-                paths = []
-                for i in range(self.n_workers):
-                    paths += hlp.load_object(self.variables_server.get("paths_{}".format(i)))
+                rollout = self.collect_rollouts()
             else:
                 self.test_mode = True
                 self.make_rollout()
-                paths = self.paths
+                rollout = self.rollout
 
-            total_rewards = np.array([path["total"] for path in paths])
-            eplens = np.array([len(path["rewards"]) for path in paths])
+            total_rewards = rollout["totals"]
+            eplens = np.diff(rollout["offsets"])
 
             print("""
 -------------------------------------------------------------
@@ -33,6 +33,8 @@ class DDPGTrainer(DDPGNetwork):
         self.test_every = args['test_every']
         self.random_steps = args['random_steps']
         self.step_delay = args['step_delay']
+        self.replay_ratio = args.get('replay_ratio', None)
+        self.replay_ratio_slack = args.get('replay_ratio_slack', 1000)
         self.xp_size = args['xp_size']
         self.save_every = args.get('save_every', 1)
         self.clip_error = args.get('clip_error', 10.)
@@ -111,6 +113,25 @@ class DDPGTrainer(DDPGNetwork):
         weights = [hlp.load_object(self.variables_server.get("weight_{}".format(i))) for i in range(len(self.weights))]
         self.set_weights(weights)
 
+    def wait_for_learner(self, n_transitions):
+        if self.replay_ratio is None:
+            time.sleep(self.step_delay)
+            return
+        while True:
+            n_updates = int(self.variables_server.get('n_updates') or 0)
+            if n_updates + self.replay_ratio_slack >= self.replay_ratio * n_transitions:
+                return
+            time.sleep(self.step_delay)
+
+    def wait_for_workers(self, n_updates):
+        if self.replay_ratio is None:
+            return
+        while True:
+            n_transitions = int(self.variables_server.get('n_transitions') or 0)
+            if n_updates <= self.replay_ratio * n_transitions + self.replay_ratio_slack:
+                return
+            time.sleep(self.step_delay)
+
     def work(self):
         self.variables_server = Redis(port=12000)
         if self.scale != 'off':
@@ -141,8 +162,9 @@ class DDPGTrainer(DDPGNetwork):
                     actions += np.random.normal(0, scale=self.action_noise, size=actions.shape)
                 env.step(actions)
                 transition = hlp.dump_object([self.last_state, env.reward, actions, env.features, env.done])
-                time.sleep(self.step_delay)
                 self.variables_server.lpush('transitions', transition)
+                n_transitions = self.variables_server.incr('n_transitions')
+                self.wait_for_learner(n_transitions)
                 self.last_state = env.features
                 if time.time() - st > 3:
                     st = time.time()
@@ -254,6 +276,8 @@ class DDPGTrainer(DDPGNetwork):
         weights = self.get_weights()
         for i, weight in enumerate(weights):
             self.variables_server.set("weight_" + str(i), hlp.dump_object(weight))
+        self.variables_server.set('n_transitions', 0)
+        self.variables_server.set('n_updates', 0)
         worker_args = \
             {
                 'config': self.config,
@@ -268,7 +292,9 @@ class DDPGTrainer(DDPGNetwork):
 
         start_time = time.time()
         max_idx = self.variables_server.llen('transitions')
+        last_updates = last_transitions = 0
         while True:
+            self.wait_for_workers(iteration)
             obs_batch = []
             next_obs_batch = []
             done_batch = []
@@ -300,6 +326,7 @@ class DDPGTrainer(DDPGNetwork):
             weights = self.get_weights()
             for i, weight in enumerate(weights):
                 self.variables_server.set("weight_" + str(i), hlp.dump_object(weight))
+            self.variables_server.set('n_updates', iteration + 1)
             if iteration % 1000 == 0:
                 print("Iteration #{}".format(iteration))
                 self.save(self.config[:-5])
@@ -317,6 +344,7 @@ class DDPGTrainer(DDPGNetwork):
 
                 total_rewards = np.array([path["total"] for path in paths])
                 eplens = np.array([len(path["rewards"]) for path in paths])
+                n_transitions = int(self.variables_server.get('n_transitions') or 0)
 
                 if self.scale == 'full':
                     stds = np.sqrt((self.sumsqrs - np.square(self.sums) / self.sumtime) / (self.sumtime - 1))
@@ -330,6 +358,7 @@ class DDPGTrainer(DDPGNetwork):
                 Mean test score:           {test_scores}
                 Mean test episode length:  {test_eplengths}
                 Max test score:            {max_test}
+                Replay ratio:              {ratio}
                 Mean of features:          {means}
                 Std of features:           {stds}
                 Time for iteration:        {tt}
@@ -340,8 +369,11 @@ class DDPGTrainer(DDPGNetwork):
                     test_scores=np.mean(total_rewards),
                     test_eplengths=np.mean(eplens),
                     max_test=np.max(total_rewards),
+                    ratio=(iteration + 1 - last_updates) / max(1, n_transitions - last_transitions),
                     tt=time.time() - start_time
                 ))
+                last_updates = iteration + 1
+                last_transitions = n_transitions
                 self.test_scores.append(np.mean(total_rewards))
 
             iteration += 1
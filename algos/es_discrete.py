@@ -2,7 +2,6 @@ import tensorflow as tf
 import numpy as np
 import os
 import sys
-import random
 import subprocess
 from redis import Redis
 import time
@@ -18,14 +17,13 @@ class EvolutionStrategiesTrainer(FFDiscrete):
         FFDiscrete.__init__(self, sess, args)
         self.sess = sess
         self.config = args['config']
+        self.run_id = args['run_id']
         self.env = args['environment']
         self.timesteps_per_launch = args['max_pathlength']
         self.noise_scale = args['noise_scale']
         self.n_workers = args['n_workers']
         self.distributed = args['distributed']
         self.n_tasks_all = args['n_tasks']
-        self.n_tasks_all -= self.n_tasks_all % self.n_workers
-        self.n_tasks = self.n_tasks_all // self.n_workers
         self.n_pre_tasks = args['n_pre_tasks']
         self.n_tests = args['n_tests']
         self.learning_rate = args['learning_rate']
@@ -35,6 +33,34 @@ class EvolutionStrategiesTrainer(FFDiscrete):
         self.l1_reg = args.get('l1_reg', 0.005)
         self.save_every = args.get('save_every', 1)
         self.report_every = args.get('report_every', 16)
+        self.noise_table_size = args.get('noise_table_size', 25000000)
+        self.noise_seed = args.get('noise_seed', 42)
+        self.noise_table_name = 'srlf_noise_{}_{}'.format(self.config[:-5], self.run_id)
+        self.noise_table = None
+        self.gradient_chunk = args.get('gradient_chunk', 256)
+        self.gradient_dtype = np.dtype(args.get('gradient_dtype', 'float32'))
+        self.worker_gradients = args.get('worker_gradients', False) and self.distributed
+        self.replay_updates = args.get('replay_updates', False) and self.distributed
+        self.checkpoint_every = args.get('checkpoint_every', 10)
+        self.population = args.get('population', 1)
+        self.perturbation_rank = args.get('perturbation_rank')
+        self.perturbed_layers = args.get('perturbed_layers')
+        self.env_config = {key: args.get(key) for key in ['env_type', 'env_name', 'continuous']}
+        self.envs = None
+        self.step_budget = args.get('step_budget')
+        if self.step_budget is not None and self.step_budget <= 0:
+            raise Exception("step_budget must be positive")
+        self.budget_chunk = args.get('budget_chunk', 100)
+        self.allowance = 0
+        self.no_progress_steps = args.get('no_progress_steps')
+        self.median_length_cap = args.get('median_length_cap')
+        self.median_min_episodes = args.get('median_min_episodes', 10)
+        if self.population > 1:
+            self.create_population(self.population)
+        self.create_perturbation(self.perturbation_rank, self.perturbed_layers)
+        self.weight_shapes = [hlp.var_shape(w) for w in self.weights]
+        self.n_params = sum(int(np.prod(shape)) for shape in self.weight_shapes)
+        self.perturbed = [kind != 'off' for kind, _ in self.perturbation_layout]
         self.sums = self.sumsqrs = self.sumtime = 0
         self.timestep = 0
         self.velocity = []
@@ -130,6 +156,80 @@ class EvolutionStrategiesTrainer(FFDiscrete):
             weights[i] += self.momentum[i] * learning_rate / ((self.velocity[i] ** 0.5) + epsilon)
         self.set_weights(weights)
 
+    def noise_gradient(self, offsets, coefficients):
+        # dense noise is summed in place, compact noise is summed per layer through its factors
+        if self.noise_size == self.n_params:
+            return self.noise_table.weighted_sum(offsets, coefficients, self.n_params, self.gradient_chunk,
+                                                 self.gradient_dtype)
+        gradient = np.zeros(self.n_params, dtype=self.gradient_dtype)
+        coefficients = np.asarray(coefficients, dtype=self.gradient_dtype)
+        for start in range(0, len(offsets), self.gradient_chunk):
+            noises = np.stack([self.noise_table.get(offset, self.noise_size)
+                               for offset in offsets[start:start + self.gradient_chunk]])
+            gradient += self.expand_noise(noises.astype(self.gradient_dtype, copy=False),
+                                          coefficients[start:start + self.gradient_chunk])
+        return gradient
+
+    def update_from_ranks(self, offsets, ranks, flat_gradient=None):
+        weights = self.get_weights()
+        if flat_gradient is None:
+            rank_diffs = (ranks[0::2] - ranks[1::2]) / self.n_tasks_all
+            flat_gradient = self.noise_gradient(offsets, rank_diffs)
+        gradients = hlp.unflatten(flat_gradient, self.weight_shapes)
+        for i, weight in enumerate(weights):
+            if self.perturbed[i]:
+                gradients[i] -= self.l1_reg * weights[i]
+
+        if self.adam:
+            self.apply_adam_updates(gradients)
+        else:
+            for i, weight in enumerate(weights):
+                weights[i] += self.learning_rate * gradients[i]
+            self.sess.run(self.set_op, feed_dict=dict(zip(self.weights_phs, weights)))
+
+    def publish_checkpoint(self):
+        checkpoint = [self.timestep, self.get_weights(), self.momentum, self.velocity]
+        self.variables_server.set('checkpoint', hlp.dump_object(checkpoint))
+
+    def load_checkpoint(self, variables_server):
+        self.timestep, weights, self.momentum, self.velocity = hlp.load_object(variables_server.get('checkpoint'))
+        self.set_weights(weights)
+
+    def send_commands(self, name, offsets, ranks=None, checkpoint=False):
+        command = {
+            'name': name,
+            'offsets': offsets,
+            'ranks': ranks,
+            'checkpoint': checkpoint,
+        }
+        command = hlp.dump_object(command)
+        for i in range(self.n_workers):
+            self.variables_server.lpush('commands_{}'.format(i), command)
+
+    def work(self):
+        # persistent worker for replay_updates: parameters and optimizer state are kept locally
+        # and the master's update is replayed from the broadcast offsets and ranks
+        variables_server = Redis(port=12000)
+        self.noise_table = hlp.NoiseTable(self.noise_table_name, self.noise_table_size)
+        self.load_checkpoint(variables_server)
+        while True:
+            command = hlp.load_object(variables_server.blpop('commands_{}'.format(self.id_worker))[1])
+            if self.scale != 'off':
+                means = hlp.load_object(variables_server.get("means"))
+                stds = hlp.load_object(variables_server.get("stds"))
+                self.sess.run(self.norm_set_op, feed_dict=dict(zip(self.norm_phs, [means, stds])))
+            if command['checkpoint']:
+                self.load_checkpoint(variables_server)
+            elif command['ranks'] is not None:
+                self.update_from_ranks(command['offsets'], command['ranks'])
+
+            if command['name'] == 'rollout':
+                self.run_noise_tasks(variables_server, command['offsets'])
+            else:
+                self.test_mode = True
+                self.run_episodes(variables_server)
+                variables_server.lpush('tests_done', self.id_worker)
+
     def rollout_with_noise(self):
         variables_server = Redis(port=12000)
         if self.scale != 'off':
@@ -139,60 +239,198 @@ class EvolutionStrategiesTrainer(FFDiscrete):
         weights = [hlp.load_object(variables_server.get("weight_{}".format(i))) for i in
                    range(len(self.weights))]
         self.set_weights(weights)
+        self.noise_table = hlp.NoiseTable(self.noise_table_name, self.noise_table_size)
+        offsets = hlp.load_object(variables_server.get("offsets"))
+        self.run_noise_tasks(variables_server, offsets)
+
+    def pop_tasks(self, variables_server, n):
+        # tasks are popped from a shared queue until it is empty, so fast workers take more of them
+        task_ids = []
+        while len(task_ids) < n:
+            id_task = variables_server.lpop('tasks')
+            if id_task is None:
+                break
+            task_ids.append(int(id_task))
+            if task_ids[-1] % self.report_every == 0:
+                print("Rollout # {} of {}".format(task_ids[-1], self.n_tasks_all))
+        return task_ids
+
+    def report_task(self, record, id_task, scores, eplens, stopped, budget_cut, sums, sumsqrs):
+        record['task_ids'].append(id_task)
+        record['scores'].append(scores)
+        record['eplens'].append(eplens)
+        record['stopped'].append(stopped)
+        record['budget_cut'].append(budget_cut)
+        record['sums'] += sums
+        record['sumsqrs'] += sumsqrs
+
+    def take_step(self, variables_server):
+        # every env step is reserved from the shared step budget before it is made, in budget_chunk slices
+        if self.step_budget is None:
+            return True
+        if self.allowance == 0:
+            claimed = variables_server.incrby('steps_used', self.budget_chunk)
+            self.allowance = int(max(0, min(self.budget_chunk, self.step_budget - claimed + self.budget_chunk)))
+            if self.allowance == 0:
+                return False
+        self.allowance -= 1
+        return True
+
+    def length_cap(self, variables_server):
+        # episodes may run at most median_length_cap times the median length finished so far in this iteration
+        if self.median_length_cap is None:
+            return None
+        lengths = [float(length) for length in variables_server.lrange('episode_lengths', 0, -1)]
+        if len(lengths) < self.median_min_episodes:
+            return None
+        return self.median_length_cap * np.median(lengths)
+
+    def episode_cut(self, env, progress, cap):
+        # progress holds the best total reward of the episode and the timestamp it was reached at
+        if env.get_total_reward() > progress[0]:
+            progress[0], progress[1] = env.get_total_reward(), env.timestamp
+        if self.no_progress_steps is not None and env.timestamp - progress[1] >= self.no_progress_steps:
+            return True
+        return cap is not None and env.timestamp >= cap
+
+    def evaluate_task(self, variables_server, record, id_task, offsets, cap):
         env = self.env
-        seeds = hlp.load_object(variables_server.get("seeds"))
-        for id_task_for_worker in range(self.n_tasks):
-            id_task = id_task_for_worker * self.n_workers + self.id_worker
-            if id_task % self.report_every == 0:
-                print("Rollout # {} of {}".format(id_task, self.n_tasks_all))
-            seed = seeds[id_task]
-            np.random.seed(seed)
-            noises = []
-            for i, weight in enumerate(weights):
-                noise = np.random.normal(size=weight.shape)
-                noises.append(noise)
-                weights[i] += self.noise_scale * noise
-            self.set_weights(weights)
+        noise = self.noise_table.get(offsets[id_task], self.noise_size)
+        sums = np.zeros((1, env.get_observation_space()))
+        sumsqrs = np.zeros(sums.shape)
+        scores, eplens, stopped = [], [], []
+        budget_cut = False
+        for sign in [1, -1]:
+            self.perturb_weights(noise, sign * self.noise_scale)
 
             env.reset()
-
-            sums = np.zeros((1, env.get_observation_space()))
-            sumsqrs = np.zeros(sums.shape)
-
+            progress = [-np.inf, 0]
+            cut = False
             while not env.done and env.timestamp < self.timesteps_per_launch:
+                if not self.take_step(variables_server):
+                    # the budget ran out mid-episode, the task is not ranked at all
+                    budget_cut = True
+                    break
                 sums += env.features
                 sumsqrs += np.square(env.features)
 
                 actions = self.act(env.features)
                 env.step(actions)
-
-            variables_server.set("scores_{}".format(id_task),
-                                 hlp.dump_object(env.get_total_reward()))
-            variables_server.set("eplen_{}".format(id_task), hlp.dump_object(env.timestamp))
-
-            for i, weight in enumerate(weights):
-                noise = noises[i]
-                weights[i] -= 2 * self.noise_scale * noise
-            self.set_weights(weights)
-
-            env.reset()
-
-            while not env.done and env.timestamp < self.timesteps_per_launch:
-                sums += env.features
-                sumsqrs += np.square(env.features)
-
-                actions = self.act(env.features)
-                env.step(actions)
-
-            variables_server.set("scores_{}".format(-id_task),
-                                 hlp.dump_object(env.get_total_reward()))
-            variables_server.set("eplen_{}".format(-id_task), hlp.dump_object(env.timestamp))
-            variables_server.set("sum_{}".format(id_task), hlp.dump_object(sums))
-            variables_server.set("sumsqr_{}".format(id_task), hlp.dump_object(sumsqrs))
-            for i, weight in enumerate(weights):
-                noise = noises[i]
-                weights[i] += self.noise_scale * noise
-            self.set_weights(weights)
+                if not env.done and self.episode_cut(env, progress, cap):
+                    cut = True
+                    break
+
+            scores.append(env.get_total_reward())
+            eplens.append(env.timestamp)
+            stopped.append(cut)
+        self.report_task(record, id_task, scores, eplens, stopped, budget_cut, sums, sumsqrs)
+
+    def evaluate_population(self, variables_server, record, task_ids, offsets, base_weights, cap):
+        # every environment runs under its own perturbation, one batched session call advances all of them
+        if self.envs is None:
+            self.envs = [self.env] + [hlp.env_from_config(self.env_config) for _ in range(self.population - 1)]
+        n_features = self.env.get_observation_space()
+        base_flat = np.concatenate([weight.reshape(-1) for weight in base_weights])
+        noises = np.zeros((self.population, self.noise_size), dtype=np.float32)
+        for k, id_task in enumerate(task_ids):
+            noises[k] = self.noise_table.get(offsets[id_task], self.noise_size)
+        noises = self.expand_noise(noises)
+        sums = np.zeros((len(task_ids), 1, n_features))
+        sumsqrs = np.zeros(sums.shape)
+        scores = np.zeros((len(task_ids), 2))
+        eplens = np.zeros((len(task_ids), 2))
+        stopped = np.zeros((len(task_ids), 2), dtype=bool)
+        budget_cut = np.zeros(len(task_ids), dtype=bool)
+        for index, sign in enumerate([1, -1]):
+            flat_weights = base_flat + sign * self.noise_scale * noises
+            population_weights = []
+            start = 0
+            for shape in self.weight_shapes:
+                size = int(np.prod(shape))
+                population_weights.append(flat_weights[:, start:start + size].reshape([self.population] + shape))
+                start += size
+            self.set_population_weights(population_weights)
+
+            active = self.envs[:len(task_ids)]
+            for env in active:
+                env.reset()
+            progress = [[-np.inf, 0] for _ in active]
+            features = np.zeros((self.population, n_features))
+            while True:
+                running = [k for k, env in enumerate(active) if not env.done and not stopped[k, index] and
+                           not budget_cut[k] and env.timestamp < self.timesteps_per_launch]
+                if not running:
+                    break
+                for k in running:
+                    if not self.take_step(variables_server):
+                        budget_cut[k] = True
+                running = [k for k in running if not budget_cut[k]]
+                if not running:
+                    continue
+                for k in running:
+                    features[k] = active[k].features[0]
+                    sums[k] += active[k].features
+                    sumsqrs[k] += np.square(active[k].features)
+                actions = self.act_population(features)
+                for k in running:
+                    active[k].step(actions[k])
+                    if not active[k].done and self.episode_cut(active[k], progress[k], cap):
+                        stopped[k, index] = True
+            for k, env in enumerate(active):
+                scores[k, index] = env.get_total_reward()
+                eplens[k, index] = env.timestamp
+        for k, id_task in enumerate(task_ids):
+            self.report_task(record, id_task, scores[k], eplens[k], stopped[k], budget_cut[k], sums[k], sumsqrs[k])
+
+    def run_noise_tasks(self, variables_server, offsets):
+        # all results of the iteration go to the master as one record with pre-summed feature statistics
+        base_weights = self.get_weights()
+        self.sess.run(self.store_base_op)
+        record = {
+            'task_ids': [],
+            'scores': [],
+            'eplens': [],
+            'stopped': [],
+            'budget_cut': [],
+            'sums': np.zeros((1, self.env.get_observation_space())),
+            'sumsqrs': np.zeros((1, self.env.get_observation_space())),
+        }
+        self.allowance = 0
+        while self.step_budget is None or int(variables_server.get('steps_used') or 0) < self.step_budget:
+            batch = self.pop_tasks(variables_server, self.population)
+            if not batch:
+                break
+            cap = self.length_cap(variables_server)
+            if self.population > 1:
+                self.evaluate_population(variables_server, record, batch, offsets, base_weights, cap)
+            else:
+                self.evaluate_task(variables_server, record, batch[0], offsets, cap)
+            # tasks left in the queue once the budget is used up stay unevaluated
+            eplens = np.array(record['eplens'][-len(batch):]).reshape(-1)
+            stopped = np.array(record['stopped'][-len(batch):]).reshape(-1)
+            stopped |= np.repeat(record['budget_cut'][-len(batch):], 2)
+            if self.median_length_cap is not None and not np.all(stopped):
+                variables_server.rpush('episode_lengths', *eplens[~stopped].astype(int))
+        if self.allowance > 0:
+            # steps reserved but not made go back to the budget
+            variables_server.incrby('steps_used', -self.allowance)
+            self.allowance = 0
+        self.sess.run(self.restore_base_op)
+        record['task_ids'] = np.array(record['task_ids'], dtype=np.int64)
+        record['scores'] = np.array(record['scores']).reshape((-1, 2))
+        record['eplens'] = np.array(record['eplens']).reshape((-1, 2))
+        record['stopped'] = np.array(record['stopped'], dtype=bool).reshape((-1, 2))
+        record['budget_cut'] = np.array(record['budget_cut'], dtype=bool)
+        variables_server.lpush('rollouts_done', hlp.dump_object(record))
+
+        if self.worker_gradients:
+            # wait for the global rank transform and reduce the gradient over this worker's tasks
+            variables_server.blpop('ranks_ready')
+            ranks = hlp.load_object(variables_server.get('ranks'))
+            task_ids = record['task_ids']
+            rank_diffs = (ranks[2 * task_ids] - ranks[2 * task_ids + 1]) / self.n_tasks_all
+            gradient = self.noise_gradient(offsets[task_ids], rank_diffs)
+            variables_server.lpush('gradients', hlp.dump_object(gradient))
 
     def make_rollout(self):
         variables_server = Redis(port=12000)
@@ -209,6 +447,9 @@ class EvolutionStrategiesTrainer(FFDiscrete):
             self.set_weights(weights)
         except:
             pass
+        self.run_episodes(variables_server)
+
+    def run_episodes(self, variables_server):
         env = self.env
         if self.test_mode:
             n_tasks = self.n_tests
@@ -259,6 +500,7 @@ class EvolutionStrategiesTrainer(FFDiscrete):
                         {
                             'config': self.config,
                             'test_mode': False,
+                            'run_id': self.run_id,
                         }
                     hlp.launch_workers(worker_args, self.n_workers)
                     paths = []
@@ -280,27 +522,32 @@ class EvolutionStrategiesTrainer(FFDiscrete):
                 self.variables_server.set("means", hlp.dump_object(means))
                 self.variables_server.set("stds", hlp.dump_object(stds))
                 self.sess.run(self.norm_set_op, feed_dict=dict(zip(self.norm_phs, [means, stds])))
+        self.noise_table = hlp.NoiseTable(self.noise_table_name, self.noise_table_size, seed=self.noise_seed)
+        random_state = np.random.RandomState()
+        if self.replay_updates:
+            for i in range(self.n_workers):
+                self.variables_server.delete('commands_{}'.format(i))
+            self.publish_checkpoint()
+            worker_args = \
+                {
+                    'config': self.config,
+                    'test_mode': False,
+                    'run_id': self.run_id,
+                }
+            hlp.launch_workers(worker_args, self.n_workers, command='work', wait=False)
+        iteration = 0
         while True:
             print("Iteration {}".format(self.timestep))
             start_time = time.time()
-            weight_noises = []
-            random.seed()
-            seed_for_random = random.randint(0, np.iinfo(np.int32).max)
-            np.random.seed(seed_for_random)
-            seeds = np.random.randint(-np.iinfo(np.int32).min + np.iinfo(np.int32).max, size=self.n_tasks_all)
-            self.variables_server.set("seeds", hlp.dump_object(seeds))
-
-            weights = self.get_weights()
-            for i, weight in enumerate(weights):
-                self.variables_server.set("weight_" + str(i), hlp.dump_object(weight))
-                weight_noises.append(np.empty((self.n_tasks_all,) + weight.shape))
-
-            for index in range(self.n_tasks_all):
-                np.random.seed(seeds[index])
-                for i, weight in enumerate(weights):
-                    weight_noises[i][index] = np.random.normal(size=weight.shape)
-
-            if self.distributed:
+            offsets = self.noise_table.sample_offsets(random_state, self.noise_size, self.n_tasks_all)
+            self.variables_server.set("offsets", hlp.dump_object(offsets))
+            self.variables_server.delete('rollouts_done', 'ranks_ready', 'gradients', 'tasks',
+                                         'steps_used', 'episode_lengths')
+            self.variables_server.rpush('tasks', *range(self.n_tasks_all))
+
+            if self.replay_updates:
+                self.send_commands('rollout', offsets)
+            elif self.distributed:
                 weights = self.get_weights()
                 for i, weight in enumerate(weights):
                     self.variables_server.set("weight_" + str(i), hlp.dump_object(weight))
@@ -308,53 +555,79 @@ class EvolutionStrategiesTrainer(FFDiscrete):
                     {
                         'config': self.config,
                         'test_mode': False,
+                        'run_id': self.run_id,
                     }
-                hlp.launch_workers(worker_args, self.n_workers, command='rollout_with_noise')
-                paths = []
-                for i in range(self.n_workers):
-                    paths += hlp.load_object(self.variables_server.get("paths_{}".format(i)))
+                hlp.launch_workers(worker_args, self.n_workers, command='rollout_with_noise',
+                                   wait=not self.worker_gradients)
             else:
+                # the master works through the task queue itself and leaves one record like a worker
                 self.test_mode = False
-                self.make_rollout()
-                paths = self.paths
-
-            scores = []
-            train_lengths = []
-            for i in range(self.n_tasks_all):
-                scores.append(hlp.load_object(self.variables_server.get("scores_" + str(i))))
-                train_lengths.append(hlp.load_object(self.variables_server.get("eplen_" + str(i))))
-                scores.append(hlp.load_object(self.variables_server.get("scores_" + str(-i))))
-                train_lengths.append(hlp.load_object(self.variables_server.get("eplen_" + str(-i))))
-
-            scores = np.array(scores)
-            train_mean_score = np.mean(scores)
+                self.run_noise_tasks(self.variables_server, offsets)
+
+            scores = np.zeros((self.n_tasks_all, 2))
+            train_lengths = np.zeros((self.n_tasks_all, 2))
+            stopped = np.zeros((self.n_tasks_all, 2), dtype=bool)
+            evaluated = np.zeros(self.n_tasks_all, dtype=bool)
+            train_sums = train_sumsqrs = 0
+            for _ in range(self.n_workers if self.distributed else 1):
+                record = hlp.load_object(self.variables_server.blpop('rollouts_done')[1])
+                scores[record['task_ids']] = record['scores']
+                train_lengths[record['task_ids']] = record['eplens']
+                stopped[record['task_ids']] = record['stopped']
+                # a task with an episode cut by the step budget is left out like the tasks it skipped
+                evaluated[record['task_ids']] = ~record['budget_cut']
+                train_sums += record['sums']
+                train_sumsqrs += record['sumsqrs']
+
+            # positive and negative perturbation of task i are at 2 * i and 2 * i + 1
+            scores = scores.reshape(-1)
+            train_lengths = train_lengths.reshape(-1)
+            n_evaluated = np.sum(evaluated)
+            evaluated = np.repeat(evaluated, 2)
+            stopped = stopped.reshape(-1) & evaluated
+            train_mean_score = np.mean(scores[evaluated]) if n_evaluated > 0 else "-"
+            max_train = np.max(scores[evaluated]) if n_evaluated > 0 else "-"
             ranks = np.zeros(shape=scores.shape)
 
-            if self.normalize == 'ranks':
-                ranks[np.argsort(scores)] = np.arange(ranks.shape[0], dtype=np.float32) / (
-                    ranks.shape[0] - 1)
-                ranks -= 0.5
-            elif self.normalize == 'center':
-                ranks = scores[:]
-                ranks -= train_mean_score
-                ranks /= (np.std(ranks, ddof=1) + 0.001)
-
-            gradients = [np.zeros(w.get_shape()) for w in self.weights]
-            for i, weight in enumerate(weights):
-                for index in 2 * np.arange(seeds.shape[0]):
-                    gradients[i] += weight_noises[i][index // 2] * (ranks[index] - ranks[index + 1]) / self.n_tasks_all
-                gradients[i] -= self.l1_reg * weights[i]
-
-            if self.adam:
-                self.apply_adam_updates(gradients)
-            else:
-                for i, weight in enumerate(weights):
-                    weights[i] += self.learning_rate * gradients[i]
-                self.sess.run(self.set_op, feed_dict=dict(zip(self.weights_phs, weights)))
+            # episodes stopped by no progress or the length cap are ranked by their partial return,
+            # tasks skipped or cut by the budget get zero rank
+            # and the rest are rescaled so that the update stays a mean over the evaluated tasks
+            if self.normalize == 'ranks' and n_evaluated > 0:
+                evaluated_ranks = np.zeros(2 * n_evaluated)
+                evaluated_ranks[np.argsort(scores[evaluated])] = np.arange(2 * n_evaluated, dtype=np.float32) / (
+                    2 * n_evaluated - 1)
+                ranks[evaluated] = (evaluated_ranks - 0.5) * self.n_tasks_all / n_evaluated
+            elif self.normalize == 'center' and n_evaluated > 0:
+                ranks[evaluated] = scores[evaluated] - train_mean_score
+                ranks[evaluated] /= (np.std(ranks[evaluated], ddof=1) + 0.001) * n_evaluated / self.n_tasks_all
+            mean_length = np.mean(train_lengths[evaluated]) if n_evaluated > 0 else 0
+            # the steps already run by tasks cut by the budget were not saved
+            steps_saved = np.sum(self.timesteps_per_launch - train_lengths[stopped]) + \
+                          2 * (self.n_tasks_all - n_evaluated) * mean_length - np.sum(train_lengths[~evaluated])
+
+            flat_gradient = None
+            if self.worker_gradients:
+                self.variables_server.set('ranks', hlp.dump_object(ranks))
+                self.variables_server.lpush('ranks_ready', *range(self.n_workers))
+                flat_gradient = np.sum([hlp.load_object(self.variables_server.blpop('gradients')[1])
+                                        for _ in range(self.n_workers)], axis=0)
+            self.update_from_ranks(offsets, ranks, flat_gradient)
+            iteration += 1
 
             print("Time to testing!")
 
-            if self.distributed:
+            if self.replay_updates:
+                checkpoint = iteration % self.checkpoint_every == 0
+                if checkpoint:
+                    self.publish_checkpoint()
+                self.variables_server.delete('tests_done')
+                self.send_commands('test', offsets, ranks, checkpoint)
+                for _ in range(self.n_workers):
+                    self.variables_server.blpop('tests_done')
+                paths = []
+                for i in range(self.n_workers):
+                    paths += hlp.load_object(self.variables_server.get("paths_{}".format(i)))
+            elif self.distributed:
                 weights = self.get_weights()
                 for i, weight in enumerate(weights):
                     self.variables_server.set("weight_" + str(i), hlp.dump_object(weight))
@@ -362,6 +635,7 @@ class EvolutionStrategiesTrainer(FFDiscrete):
                     {
                         'config': self.config,
                         'test_mode': True,
+                        'run_id': self.run_id,
                     }
                 hlp.launch_workers(worker_args, self.n_workers)
                 paths = []
@@ -375,9 +649,8 @@ class EvolutionStrategiesTrainer(FFDiscrete):
             total_rewards = np.array([path["total"] for path in paths])
             eplens = np.array([len(path["rewards"]) for path in paths])
             if self.scale:
-                for i in range(self.n_tasks_all):
-                    self.sums += hlp.load_object(self.variables_server.get("sum_{}".format(i)))
-                    self.sumsqrs += hlp.load_object(self.variables_server.get("sumsqr_{}".format(i)))
+                self.sums += train_sums
+                self.sumsqrs += train_sumsqrs
                 self.sumtime += np.sum(train_lengths)
                 stds = np.sqrt((self.sumsqrs - np.square(self.sums) / self.sumtime) / (self.sumtime - 1))
                 means = self.sums / self.sumtime
@@ -393,6 +666,9 @@ Mean test episode length:  {test_eplengths}
 Mean train episode length: {train_eplengths}
 Max test score:            {max_test}
 Max train score:           {max_train}
+Tasks evaluated:           {n_evaluated} of {n_tasks}
+Episodes stopped early:    {n_stopped}
+Env steps saved (bound):   {steps_saved}
 Mean of features:          {means}
 Std of features:           {stds}
 Time for iteration:        {tt}
@@ -403,12 +679,17 @@ Time for iteration:        {tt}
                 test_scores=np.mean(total_rewards),
                 test_eplengths=np.mean(eplens),
                 train_scores=train_mean_score,
-                train_eplengths=np.mean(train_lengths),
+                train_eplengths=mean_length,
                 max_test=np.max(total_rewards),
-                max_train=np.max(scores),
+                max_train=max_train,
+                n_evaluated=n_evaluated,
+                n_tasks=self.n_tasks_all,
+                n_stopped=np.sum(stopped),
+                steps_saved=int(steps_saved),
                 tt=time.time() - start_time
             ))
-            self.train_scores.append(train_mean_score)
+            if n_evaluated > 0:
+                self.train_scores.append(train_mean_score)
             self.test_scores.append(np.mean(total_rewards))
             if self.timestep % self.save_every == 0:
                 self.save(self.config[:-5])
@@ -28,7 +28,27 @@ class TRPOContinuousTrainer(FFContinuous):
         self.scale = args['scale']
         self.gamma = args['gamma']
         self.value_updates = args['value_updates']
+        self.value_minibatches = args.get('value_minibatches', 1)
+        self.value_holdout = args.get('value_holdout', 0.)
+        self.value_patience = args.get('value_patience', 1)
+        if self.value_minibatches < 1 or not 0 <= self.value_holdout < 1:
+            raise Exception("value_minibatches must be positive and value_holdout in [0, 1)")
+        self.value_split = None
         self.save_every = args.get('save_every', 1)
+        self.data_parallel = args.get('data_parallel', False) and self.distributed
+        self.fvp_fraction = args.get('fvp_fraction', 1.0)
+        self.fvp_method = args.get('fvp_method', 'double_backprop')
+        self.fvp_check = args.get('fvp_check', self.fvp_method == 'gauss_newton')
+        self.fvp_check_calls = args.get('fvp_check_calls', 10)
+        self.cg_iters = args.get('cg_iters', 10)
+        self.cg_relative_tol = args.get('cg_relative_tol')
+        self.cg_warm_start = args.get('cg_warm_start', False)
+        self.cg_precondition = args.get('cg_precondition', False)
+        self.precondition_batch = args.get('precondition_batch', 64)
+        self.stepdir = None
+        self.pipeline = args.get('pipeline', False) and self.distributed and not self.data_parallel
+        self.shared_budget = args.get('shared_budget', False) and self.distributed
+        self.budget_chunk = args.get('budget_chunk', 100)
         self.sums = self.sumsqrs = self.sumtime = 0
         self.timestep = 0
         self.std = args['std']
@@ -49,6 +69,8 @@ class TRPOContinuousTrainer(FFContinuous):
             "action": tf.placeholder(dtype=tf.float32, shape=[None, len(self.n_actions)]),
             "old_mean": tf.placeholder(dtype=tf.float32, shape=[None, len(self.n_actions)]),
             "old_std": tf.placeholder(dtype=tf.float32, shape=[None, len(self.n_actions)]),
+            "kl_mean": tf.placeholder(dtype=tf.float32, shape=[None, len(self.n_actions)]),
+            "kl_std": tf.placeholder(dtype=tf.float32, shape=[None, len(self.n_actions)]),
             "flat_tangent": tf.placeholder(dtype=tf.float32, shape=[None])
         }
         actions = self.targets["action"]
@@ -71,13 +93,12 @@ class TRPOContinuousTrainer(FFContinuous):
                 tf.log(std2) - tf.log(std1) + (tf.square(std1) + tf.square(mean1 - mean2)) / (2 * tf.square(std2)),
                 axis=1))
 
-        self.KL = KL_gauss(old_action_means, old_action_stds, action_means, action_stds)
+        # the ratio is taken against the policy that collected the data, the trust region is centered on the
+        # policy at the start of the update; both are the same unless the rollouts are pipelined
+        self.KL = KL_gauss(self.targets["kl_mean"], self.targets["kl_std"], action_means, action_stds)
 
         self.policy_grad = hlp.flatgrad(self.loss, self.weights)
-        fixed_means = tf.stop_gradient(action_means)
-        fixed_stds = tf.stop_gradient(action_stds)
-        KL_firstfixed = KL_gauss(fixed_means, fixed_stds, action_means, action_stds)
-        kl_ff_grads = tf.gradients(KL_firstfixed, self.weights)
+        self.log_prob_grad = hlp.flatgrad(tf.reduce_mean(log_p), self.weights)
         w_shapes = list(map(hlp.var_shape, self.weights))
         start = 0
         tangents = []
@@ -86,15 +107,35 @@ class TRPOContinuousTrainer(FFContinuous):
             param = tf.reshape(self.targets["flat_tangent"][start:(start + size)], shape)
             tangents.append(param)
             start += size
+        # both products are in the graph so that fvp_check can compare them, fvp_method picks the one used
+        # the Fisher metric of a Gaussian is 1 / std^2 in its means and 2 / std^2 in its stds
+        stds = action_stds * tf.ones_like(action_means)
+        outputs = [action_means, stds]
+        metrics = [1 / tf.square(stds), 2 / tf.square(stds)]
+        n_rows = tf.cast(tf.shape(self.state_input)[0], tf.float32)
+        gauss_newton = hlp.gauss_newton_vector_product(outputs, metrics, self.weights, tangents) / n_rows
+
+        fixed_means = tf.stop_gradient(action_means)
+        fixed_stds = tf.stop_gradient(action_stds)
+        KL_firstfixed = KL_gauss(fixed_means, fixed_stds, action_means, action_stds)
+        kl_ff_grads = tf.gradients(KL_firstfixed, self.weights)
         gvp = [tf.reduce_sum(g * t) for (g, t) in zip(kl_ff_grads, tangents)]
-        self.fisher_vector_product = hlp.flatgrad(gvp, self.weights)
+        double_backprop = hlp.flatgrad(gvp, self.weights)
+
+        self.fvp_products = {'gauss_newton': gauss_newton, 'double_backprop': double_backprop}
+        self.fisher_vector_product = self.fvp_products[self.fvp_method]
 
         self.get_flat = hlp.GetFlat(self.weights, self.sess)
         self.set_from_flat = hlp.SetFromFlat(self.weights, self.sess)
 
-        value_loss = tf.reduce_mean((self.targets["return"] - self.value) ** 2)
+        self.value_loss = tf.reduce_mean((self.targets["return"] - self.value) ** 2)
 
-        self.value_train_op = tf.train.AdamOptimizer(0.05).minimize(value_loss, var_list=self.value_weights)
+        value_optimizer = tf.train.AdamOptimizer(0.05)
+        self.value_train_op = value_optimizer.minimize(self.value_loss, var_list=self.value_weights)
+        self.value_shapes = list(map(hlp.var_shape, self.value_weights))
+        self.value_gradient = hlp.flatgrad(self.value_loss, self.value_weights)
+        self.value_gradient_phs = [tf.placeholder(tf.float32, shape=shape) for shape in self.value_shapes]
+        self.value_apply_op = value_optimizer.apply_gradients(zip(self.value_gradient_phs, self.value_weights))
 
     def save(self, name):
         directory = 'saves/' + name + '/'
@@ -165,16 +206,35 @@ class TRPOContinuousTrainer(FFContinuous):
                 self.sess.run(self.norm_set_op, feed_dict=dict(zip(self.norm_phs, [means, stds])))
             except:
                 pass
+        # test workers have keys of their own, so they can run next to a pipelined train batch
+        prefix = "test_" if self.test_mode else ""
         try:
-            weights = [hlp.load_object(variables_server.get("weight_{}".format(i))) for i in
+            weights = [hlp.load_object(variables_server.get(prefix + "weight_{}".format(i))) for i in
                        range(len(self.weights))]
             self.set_weights(weights)
         except:
             pass
+        rollout = self.run_rollout(variables_server)
+        if self.distributed:
+            variables_server.set(prefix + "rollout_{}".format(self.id_worker), hlp.dump_object(rollout))
+        else:
+            self.rollout = rollout
+
+    def claim_steps(self, variables_server):
+        # atomically takes up to budget_chunk steps of the batch, 0 once the whole batch is claimed
+        claimed = variables_server.incrby('steps_claimed', self.budget_chunk)
+        return int(max(0, min(self.budget_chunk, self.timesteps_per_batch - claimed + self.budget_chunk)))
+
+    def run_rollout(self, variables_server=None):
+        # with a shared budget workers draw steps from one counter, so faster workers collect more of the batch
         env = self.env
+        shared = self.shared_budget and not self.test_mode
         if self.test_mode:
             n_tasks = self.n_tests
             timesteps_per_worker = 100000000
+        elif shared:
+            n_tasks = 10000
+            timesteps_per_worker = self.timesteps_per_batch
         else:
             n_tasks = 10000
             timesteps_per_worker = self.timesteps_per_batch // self.n_workers
@@ -182,48 +242,264 @@ class TRPOContinuousTrainer(FFContinuous):
         timestep = 0
         i_task = 0
 
-        paths = []
+        # no episode starts once the budget is reached, so the last one ends at most one launch after it
+        capacity = min(n_tasks * self.timesteps_per_launch, timesteps_per_worker + self.timesteps_per_launch)
+        buffer = hlp.RolloutBuffer(capacity, env.get_observation_space(), len(self.n_actions), 2 * len(self.n_actions))
+        allowance = 0
         while timestep < timesteps_per_worker and i_task < n_tasks:
-            path = {}
-            observations, action_tuples, rewards, dist_tuples, timestamps = [], [], [], [], []
-            sums = np.zeros((1, env.get_observation_space()))
-            sumsqrs = np.zeros(sums.shape)
-
+            if shared and allowance == 0:
+                allowance = self.claim_steps(variables_server)
+                if allowance == 0:
+                    break
             env.reset()
             while not env.done and env.timestamp < self.timesteps_per_launch:
-                sums += env.features
-                sumsqrs += np.square(env.features)
-                observations.append(env.features[0])
-                timestamps.append(env.timestamp)
-
+                if shared and allowance == 0:
+                    # the budget is used up, the episode is cut and bootstraps like one cut by max_pathlength
+                    allowance = self.claim_steps(variables_server)
+                    if allowance == 0:
+                        break
+                features = env.features
+                timestamp = env.timestamp
+
+                dist_tuple = None
                 if not self.test_mode:
                     actions, dist_tuple = self.act(env.features, return_dists=True)
-                    dist_tuples.append(dist_tuple)
                 else:
                     actions = self.act(env.features, exploration=False)
                 env.step(actions)
                 timestep += 1
+                allowance -= 1
 
-                action_tuples.append(actions)
-                rewards.append(env.reward)
-
-            path["observations"] = np.array(observations)
-            path["action_tuples"] = np.array(action_tuples)
-            path["rewards"] = np.array(rewards)
-            if not self.test_mode:
-                path["dist_tuples"] = np.array(dist_tuples)
-            path["timestamps"] = np.array(timestamps)
-            path["sumobs"] = sums
-            path["sumsqrobs"] = sumsqrs
-            path["terminated"] = env.done
-            path["total"] = env.get_total_reward()
-            paths.append(path)
+                buffer.add(features, actions, env.reward, timestamp, dist_tuple)
+
+            buffer.end_episode(env.done, env.get_total_reward())
             i_task += 1
 
-        if self.distributed:
-            variables_server.set("paths_{}".format(self.id_worker), hlp.dump_object(paths))
+        return buffer.record()
+
+    def launch_rollouts(self, test_mode=False, wait=True):
+        prefix = "test_" if test_mode else ""
+        if not test_mode:
+            self.variables_server.delete('steps_claimed')
+        weights = self.get_weights()
+        for i, weight in enumerate(weights):
+            self.variables_server.set(prefix + "weight_" + str(i), hlp.dump_object(weight))
+        worker_args = \
+            {
+                'config': self.config,
+                'test_mode': test_mode,
+            }
+        return hlp.launch_workers(worker_args, self.n_workers, wait=wait)
+
+    def collect_rollouts(self, test_mode=False):
+        prefix = "test_" if test_mode else ""
+        return hlp.merge_rollouts([hlp.load_object(self.variables_server.get(prefix + "rollout_{}".format(i)))
+                                   for i in range(self.n_workers)])
+
+    def compute_targets(self, rollout):
+        # one value pass over the whole batch, the last step of an unfinished episode bootstraps from itself
+        rewards = rollout["rewards"]
+        timestamps = rollout["timestamps"]
+        offsets = rollout["offsets"]
+        if rewards.shape[0] == 0:
+            return np.zeros(0), np.zeros(0)
+        ends = offsets[1:] - 1
+        values = self.sess.run(self.value, feed_dict={self.state_input: rollout["observations"]})
+        next_values = np.append(values[1:], 0)
+        next_values[ends] = np.where(rollout["terminated"], 0, values[ends])
+        deltas = rewards + self.gamma * next_values - values
+        returns = hlp.discount_paths(rewards, self.gamma, timestamps, offsets)
+        advantages = hlp.discount_paths(deltas, self.gamma, timestamps, offsets)
+        return returns, advantages
+
+    def normalize_advantages(self, advantages):
+        if self.normalize == 'ranks':
+            ranks = np.zeros_like(advantages)
+            ranks[np.argsort(advantages)] = np.arange(ranks.shape[0], dtype=np.float32) / (ranks.shape[0] - 1)
+            ranks -= 0.5
+            advantages = ranks[:]
+        elif self.normalize == 'center':
+            advantages -= np.mean(advantages)
+            advantages /= (np.std(advantages, ddof=1) + 0.001)
+        return advantages
+
+    def current_dists(self, observations):
+        means, stds = self.sess.run([self.action_means, self.action_stds], feed_dict={self.state_input: observations})
+        return np.concatenate([means, stds * np.ones_like(means)], axis=1)
+
+    def batch_feed_dict(self, rollout, returns, advantages):
+        kl_dists = self.current_dists(rollout["observations"]) if self.pipeline else rollout["dists"]
+        return {self.state_input: rollout["observations"],
+                self.targets["return"]: returns,
+                self.targets["advantage"]: advantages,
+                self.targets["old_mean"]: rollout["dists"][:, :len(self.n_actions)],
+                self.targets["old_std"]: rollout["dists"][:, len(self.n_actions):],
+                self.targets["kl_mean"]: kl_dists[:, :len(self.n_actions)],
+                self.targets["kl_std"]: kl_dists[:, len(self.n_actions):],
+                self.targets["action"]: rollout["actions"]}
+
+    def value_feed_dict(self, indices):
+        return {self.state_input: self.feed_dict[self.state_input][indices],
+                self.targets["return"]: self.feed_dict[self.targets["return"]][indices]}
+
+    def value_minibatch(self, epoch=None, minibatch=None):
+        # indices of one value-fitting minibatch of the kept batch, or of its held-out part if minibatch is None;
+        # the split is made once per epoch and the held-out part is the same in all of them
+        if self.value_split is None or epoch is not None and epoch != self.value_split[0]:
+            epoch = epoch or 0
+            minibatches, holdout = hlp.minibatch_split(self.batch_size, self.value_minibatches, epoch,
+                                                       self.value_holdout)
+            self.value_split = epoch, minibatches, holdout
+        _, minibatches, holdout = self.value_split
+        return holdout if minibatch is None else minibatches[minibatch]
+
+    def prepare_batch(self, rollout):
+        # keeps the batch resident for evaluate and returns the part of it the master needs
+        returns, advantages = self.compute_targets(rollout)
+        self.feed_dict = self.batch_feed_dict(rollout, returns, advantages)
+        self.batch_size = returns.shape[0]
+        self.value_split = None
+        # the curvature is estimated on fixed, evenly spaced rows of the batch, gradient and line search use all
+        if self.fvp_fraction < 1.0 and self.batch_size > 0:
+            n_rows = max(1, int(np.ceil(self.fvp_fraction * self.batch_size)))
+            self.fvp_index = (np.arange(n_rows) * self.batch_size) // n_rows
+            self.fvp_feed_dict = {ph: value[self.fvp_index] for ph, value in self.feed_dict.items()}
+        else:
+            self.fvp_index = None
+            self.fvp_feed_dict = self.feed_dict
+        offsets = rollout["offsets"]
+        return {
+            'advantages': advantages,
+            'train_rewards': np.add.reduceat(rollout["rewards"], offsets[:-1]) if self.batch_size > 0 else np.zeros(0),
+            'train_lengths': np.diff(offsets),
+            'sumobs': rollout["sumobs"],
+            'sumsqrobs': rollout["sumsqrobs"],
+            'worker_steps': rollout.get("record_steps", np.array([self.batch_size])),
+        }
+
+    def evaluate(self, command, payload=None):
+        # sums over the resident batch, batch_call turns them into means over the whole batch
+        if command == 'advantages':
+            self.feed_dict[self.targets["advantage"]] = payload
+            if self.fvp_index is not None:
+                self.fvp_feed_dict[self.targets["advantage"]] = payload[self.fvp_index]
+            return None
+        if self.batch_size == 0:
+            # a worker left without steps by the shared budget adds zero sums instead of running on an empty feed
+            if command == 'loss_kl':
+                self.set_from_flat(payload)
+                return np.zeros(2)
+            if command == 'fvp_check':
+                return None
+            if command in ['value_gradient', 'value_loss']:
+                return 0, 0
+            return np.zeros(self.get_flat().shape[0])
+        if command == 'fvp_check':
+            # both Fisher-vector products on the kept batch and a fixed tangent,
+            # returns their relative difference and the seconds per call of each
+            feed_dict = dict(self.fvp_feed_dict)
+            feed_dict[self.targets["flat_tangent"]] = np.random.RandomState(0).randn(self.get_flat().shape[0])
+            products, times = [], []
+            for method in ['double_backprop', 'gauss_newton']:
+                start = time.time()
+                for _ in range(payload):
+                    product = self.sess.run(self.fvp_products[method], feed_dict)
+                times.append((time.time() - start) / payload)
+                products.append(product)
+            difference = np.linalg.norm(products[1] - products[0]) / (np.linalg.norm(products[0]) + 1e-10)
+            return np.array([difference] + times)
+        if command == 'fisher_diagonal':
+            # on-policy score gradients have zero mean, so the square of a minibatch mean estimates
+            # the diagonal of the Fisher divided by the minibatch size
+            result = 0
+            rows = [ph for ph in self.feed_dict if ph is not self.targets["flat_tangent"]]
+            for start in range(0, self.batch_size, self.precondition_batch):
+                feed_dict = {ph: self.feed_dict[ph][start:start + self.precondition_batch] for ph in rows}
+                size = feed_dict[self.state_input].shape[0]
+                result += size * size * np.square(self.sess.run(self.log_prob_grad, feed_dict))
+            return result
+        if command in ['value_gradient', 'value_loss']:
+            # sums over this process's rows of the minibatch or of the held-out part, and their number
+            if command == 'value_gradient':
+                self.set_value_weights(payload['value_weights'])
+                indices = self.value_minibatch(payload['epoch'], payload['minibatch'])
+                tensor = self.value_gradient
+            else:
+                self.set_value_weights(payload)
+                indices = self.value_minibatch()
+                tensor = self.value_loss
+            if indices.shape[0] == 0:
+                return 0, 0
+            return self.sess.run(tensor, self.value_feed_dict(indices)) * indices.shape[0], indices.shape[0]
+        if command == 'policy_gradient':
+            result = self.sess.run(self.policy_grad, self.feed_dict)
+        elif command == 'fisher_vector_product':
+            self.fvp_feed_dict[self.targets["flat_tangent"]] = payload
+            result = self.sess.run(self.fisher_vector_product, self.fvp_feed_dict)
+        elif command == 'loss_kl':
+            self.set_from_flat(payload)
+            result = np.array(self.sess.run([self.loss, self.KL], self.feed_dict))
         else:
-            self.paths = paths
+            raise Exception
+        return result * self.batch_size
+
+    def request(self, command, payloads):
+        # one command per data-parallel worker, results come back ordered by worker
+        for i, payload in enumerate(payloads):
+            self.variables_server.lpush('commands_{}'.format(i), hlp.dump_object([command, payload]))
+        results = [None] * self.n_workers
+        for _ in range(self.n_workers):
+            id_worker, result = hlp.load_object(self.variables_server.blpop('results')[1])
+            results[id_worker] = result
+        return results
+
+    def batch_call(self, command, payload=None):
+        if self.data_parallel:
+            return np.sum(self.request(command, [payload] * self.n_workers), axis=0) / self.n_steps
+        return self.evaluate(command, payload) / self.n_steps
+
+    def serve_batch(self):
+        # data-parallel worker: collects its slice of every batch and answers the master's batch calls on it
+        variables_server = Redis(port=12000)
+        while True:
+            command, payload = hlp.load_object(variables_server.blpop('commands_{}'.format(self.id_worker))[1])
+            if command == 'rollout':
+                self.set_weights(payload['weights'])
+                self.set_value_weights(payload['value_weights'])
+                self.sess.run(self.norm_set_op, feed_dict=dict(zip(self.norm_phs, payload['norm'])))
+                self.test_mode = False
+                result = self.prepare_batch(self.run_rollout(variables_server))
+            else:
+                result = self.evaluate(command, payload)
+            variables_server.lpush('results', hlp.dump_object([self.id_worker, result]))
+
+    def fit_value(self):
+        # minibatch epochs over the batch, stopped early on the held-out loss if value_holdout is set
+        def reduce(command, payload):
+            if self.data_parallel:
+                results = self.request(command, [payload] * self.n_workers)
+            else:
+                results = [self.evaluate(command, payload)]
+            return sum(result[0] for result in results), sum(result[1] for result in results)
+
+        def train_step(epoch, minibatch):
+            if self.data_parallel:
+                payload = {'value_weights': self.get_value_weights(), 'epoch': epoch, 'minibatch': minibatch}
+                gradient, size = reduce('value_gradient', payload)
+                if size > 0:
+                    gradients = hlp.unflatten(gradient / size, self.value_shapes)
+                    self.sess.run(self.value_apply_op, feed_dict=dict(zip(self.value_gradient_phs, gradients)))
+            else:
+                indices = self.value_minibatch(epoch, minibatch)
+                if indices.shape[0] > 0:
+                    self.sess.run(self.value_train_op, self.value_feed_dict(indices))
+
+        def holdout_loss():
+            loss, size = reduce('value_loss', self.get_value_weights())
+            return loss / size if size > 0 else None
+
+        return hlp.fit_minibatches(train_step, self.value_minibatches, self.value_updates,
+                                   holdout_loss if self.value_holdout > 0 else None, self.value_patience)
 
     def train(self):
         cmd_server = 'redis-server --port 12000'
@@ -241,18 +517,15 @@ class TRPOContinuousTrainer(FFContinuous):
                             'test_mode': False,
                         }
                     hlp.launch_workers(worker_args, self.n_workers)
-                    paths = []
-                    for i in range(self.n_workers):
-                        paths += hlp.load_object(self.variables_server.get("paths_{}".format(i)))
+                    rollout = self.collect_rollouts()
                 else:
                     self.test_mode = False
                     self.make_rollout()
-                    paths = self.paths
+                    rollout = self.rollout
 
-                for path in paths:
-                    self.sums += path["sumobs"]
-                    self.sumsqrs += path["sumsqrobs"]
-                    self.sumtime += path["observations"].shape[0]
+                self.sums += rollout["sumobs"]
+                self.sumsqrs += rollout["sumsqrobs"]
+                self.sumtime += rollout["observations"].shape[0]
 
             stds = np.sqrt((self.sumsqrs - np.square(self.sums) / self.sumtime) / (self.sumtime - 1))
             means = self.sums / self.sumtime
@@ -261,116 +534,117 @@ class TRPOContinuousTrainer(FFContinuous):
             self.variables_server.set("means", hlp.dump_object(means))
             self.variables_server.set("stds", hlp.dump_object(stds))
             self.sess.run(self.norm_set_op, feed_dict=dict(zip(self.norm_phs, [means, stds])))
+        if self.data_parallel:
+            self.variables_server.delete('results', *['commands_{}'.format(i) for i in range(self.n_workers)])
+            worker_args = \
+                {
+                    'config': self.config,
+                    'test_mode': False,
+                }
+            hlp.launch_workers(worker_args, self.n_workers, command='serve_batch', wait=False)
+        pending = None
         while True:
             print("Iteration {}".format(self.timestep))
             start_time = time.time()
 
-            if self.distributed:
-                weights = self.get_weights()
-                for i, weight in enumerate(weights):
-                    self.variables_server.set("weight_" + str(i), hlp.dump_object(weight))
-                worker_args = \
-                    {
-                        'config': self.config,
-                        'test_mode': False,
-                    }
-                hlp.launch_workers(worker_args, self.n_workers)
-                paths = []
-                for i in range(self.n_workers):
-                    paths += hlp.load_object(self.variables_server.get("paths_{}".format(i)))
+            if self.data_parallel:
+                state = {
+                    'weights': self.get_weights(),
+                    'value_weights': self.get_value_weights(),
+                    'norm': self.sess.run([self.feature_means, self.feature_stds]),
+                }
+                self.variables_server.delete('steps_claimed')
+                summaries = self.request('rollout', [state] * self.n_workers)
             else:
-                self.test_mode = False
-                self.make_rollout()
-                paths = self.paths
-
-            observations = np.concatenate([path["observations"] for path in paths])
-            actions = np.concatenate([path["action_tuples"] for path in paths])
-            action_means = []
-            action_stds = []
-            returns = []
-            advantages = []
-            for path in paths:
-                self.sums += path["sumobs"]
-                self.sumsqrs += path["sumsqrobs"]
-                self.sumtime += path["rewards"].shape[0]
-                action_means += [d[0] for d in path["dist_tuples"]]
-                action_stds += [d[1] for d in path["dist_tuples"]]
-                returns += hlp.discount(path["rewards"], self.gamma, path["timestamps"]).tolist()
-                values = self.sess.run(self.value, feed_dict={self.state_input: path["observations"]})
-                values = np.append(values, 0 if path["terminated"] else values[-1])
-                deltas = (path["rewards"] + self.gamma * values[1:] - values[:-1])
-                advantages += hlp.discount(deltas, self.gamma, path["timestamps"]).tolist()
-            returns = np.array(returns)
-            advantages = np.array(advantages)
-            action_means = np.array(action_means)
-            action_stds = np.array(action_stds)
-
-            if self.normalize == 'ranks':
-                ranks = np.zeros_like(advantages)
-                ranks[np.argsort(advantages)] = np.arange(ranks.shape[0], dtype=np.float32) / (ranks.shape[0] - 1)
-                ranks -= 0.5
-                advantages = ranks[:]
-            elif self.normalize == 'center':
-                advantages -= np.mean(advantages)
-                advantages /= (np.std(advantages, ddof=1) + 0.001)
-
-            feed_dict = {self.state_input: observations,
-                         self.targets["return"]: returns,
-                         self.targets["advantage"]: advantages,
-                         self.targets["old_mean"]: action_means,
-                         self.targets["old_std"]: action_stds,
-                         self.targets["action"]: actions}
-
-            for i in range(self.value_updates):
-                self.sess.run(self.value_train_op, feed_dict)
-
-            train_rewards = np.array([path["rewards"].sum() for path in paths])
-            train_lengths = np.array([len(path["rewards"]) for path in paths])
+                if self.distributed:
+                    if pending is None:
+                        pending = self.launch_rollouts(wait=False)
+                    for process in pending:
+                        process.wait()
+                    rollout = self.collect_rollouts()
+                    # with the pipeline the next batch is collected by the current policy during this update
+                    pending = self.launch_rollouts(wait=False) if self.pipeline else None
+                else:
+                    self.test_mode = False
+                    self.make_rollout()
+                    rollout = self.rollout
+                summaries = [self.prepare_batch(rollout)]
+
+            # advantages are normalized over the whole batch, whichever process keeps its slice
+            advantages = self.normalize_advantages(np.concatenate([summary['advantages'] for summary in summaries]))
+            self.n_steps = advantages.shape[0]
+            if self.data_parallel:
+                splits = np.cumsum([summary['advantages'].shape[0] for summary in summaries])[:-1]
+                self.request('advantages', np.split(advantages, splits))
+            else:
+                self.evaluate('advantages', advantages)
+            train_rewards = np.concatenate([summary['train_rewards'] for summary in summaries])
+            train_lengths = np.concatenate([summary['train_lengths'] for summary in summaries])
+            worker_steps = np.concatenate([summary['worker_steps'] for summary in summaries])
+            self.sums += np.sum([summary['sumobs'] for summary in summaries], axis=0)
+            self.sumsqrs += np.sum([summary['sumsqrobs'] for summary in summaries], axis=0)
+            self.sumtime += self.n_steps
+
+            value_epochs, value_time = self.fit_value()
 
             thprev = self.get_flat()
 
-            def fisher_vector_product(p):
-                feed_dict[self.targets["flat_tangent"]] = p
-                return self.sess.run(self.fisher_vector_product, feed_dict) + 0.1 * p
+            if self.fvp_check:
+                # once per run, the two Fisher-vector products have to agree on the first batch
+                if self.data_parallel:
+                    checks = self.request('fvp_check', [self.fvp_check_calls] * self.n_workers)
+                    check = np.mean([check for check in checks if check is not None], axis=0)
+                else:
+                    check = self.evaluate('fvp_check', self.fvp_check_calls)
+                print("FVP check: relative difference {}, time per call double_backprop {}, gauss_newton {}".format(
+                    *check))
+                if check[0] > 1e-3:
+                    raise Exception("Gauss-Newton and double-backprop Fisher-vector products differ")
+                self.fvp_check = False
 
-            g = self.sess.run(self.policy_grad, feed_dict)
-            stepdir = hlp.conjugate_gradient(fisher_vector_product, -g)
+            fvp_stats = [0, 0.]
+
+            def fisher_vector_product(p):
+                fvp_start = time.time()
+                product = self.batch_call('fisher_vector_product', p) + 0.1 * p
+                fvp_stats[0] += 1
+                fvp_stats[1] += time.time() - fvp_start
+                return product
+
+            g = self.batch_call('policy_gradient')
+            preconditioner = None
+            if self.cg_precondition:
+                preconditioner = self.batch_call('fisher_diagonal') + 0.1
+            x0 = self.stepdir if self.cg_warm_start else None
+            stepdir, cg_iterations = hlp.conjugate_gradient(fisher_vector_product, -g, self.cg_iters, x0=x0,
+                                                            preconditioner=preconditioner,
+                                                            relative_tol=self.cg_relative_tol)
+            self.stepdir = stepdir
 
             shs = .5 * stepdir.dot(fisher_vector_product(stepdir))
             lm = np.sqrt(shs / self.max_kl)
             fullstep = stepdir / (lm + 1e-18)
 
             def loss_kl(th):
-                self.set_from_flat(th)
-                return self.sess.run([self.loss, self.KL], feed_dict=feed_dict)
+                return self.batch_call('loss_kl', th)
 
             theta = hlp.linesearch(loss_kl, thprev, fullstep, self.max_kl)
             self.set_from_flat(theta)
 
-            lossafter, kloldnew = self.sess.run([self.loss, self.KL], feed_dict=feed_dict)
+            lossafter, kloldnew = self.batch_call('loss_kl', theta)
 
             print("Time for testing!")
 
             if self.distributed:
-                weights = self.get_weights()
-                for i, weight in enumerate(weights):
-                    self.variables_server.set("weight_" + str(i), hlp.dump_object(weight))
-                worker_args = \
-                    {
-                        'config': self.config,
-                        'test_mode': True,
-                    }
-                hlp.launch_workers(worker_args, self.n_workers)
-                paths = []
-                for i in range(self.n_workers):
-                    paths += hlp.load_object(self.variables_server.get("paths_{}".format(i)))
+                self.launch_rollouts(test_mode=True)
+                rollout = self.collect_rollouts(test_mode=True)
             else:
                 self.test_mode = True
                 self.make_rollout()
-                paths = self.paths
+                rollout = self.rollout
 
-            total_rewards = np.array([path["total"] for path in paths])
-            eplens = np.array([len(path["rewards"]) for path in paths])
+            total_rewards = rollout["totals"]
+            eplens = np.diff(rollout["offsets"])
 
             if self.scale == 'full':
                 stds = np.sqrt((self.sumsqrs - np.square(self.sums) / self.sumtime) / (self.sumtime - 1))
@@ -389,6 +663,10 @@ Max test score:            {max_test}
 Max train score:           {max_train}
 KL between old and new     {kl}
 Loss after update          {loss}
+FVP calls, time per call:  {fvp_calls}, {fvp_time}
+CG iterations:             {cg_iterations}
+Value epochs, time:        {value_epochs}, {value_time}
+Steps per worker:          {worker_steps}
 Mean of features:          {means}
 Std of features:           {stds}
 Time for iteration:        {tt}
@@ -404,6 +682,12 @@ Time for iteration:        {tt}
                 max_train=np.max(train_rewards),
                 kl=kloldnew,
                 loss=lossafter,
+                fvp_calls=fvp_stats[0],
+                fvp_time=fvp_stats[1] / fvp_stats[0],
+                cg_iterations=cg_iterations,
+                value_epochs=value_epochs,
+                value_time=value_time,
+                worker_steps=worker_steps,
                 tt=time.time() - start_time
             ))
             self.timestep += 1
@@ -11,6 +11,12 @@ def denselayer(scope, x, out_dim, nonlinearity=tf.identity, w_initializer=None,
 
     return o, [w, b]
 
+def population_denselayer(x, w, b, nonlinearity=tf.identity):
+    # one dense layer per population member: x is [population, in], w is [population, in, out], b is [population, out]
+    o = nonlinearity(tf.squeeze(tf.matmul(tf.expand_dims(x, 1), w), axis=1) + b)
+
+    return o
+
 def noisy_denselayer(scope, x, out_dim, nonlinearity=tf.identity, factorized=False, init_sigma=0.5):
     x_shape = x.get_shape().as_list()
     with tf.variable_scope(scope):
@@ -1,6 +1,9 @@
 import subprocess
 import os
+import atexit
 import sys
+import tempfile
+import time
 sys.path.append(os.path.realpath(".."))
 sys.path.append(os.path.abspath("/Users/fritz/SRLF"))
 sys.path.append(os.path.abspath("/home/fritz/SRLF"))
@@ -106,6 +109,20 @@ def flatgrad(loss, var_list):
                       for (v, grad) in zip(var_list, grads)], 0)
 
 
+def gauss_newton_vector_product(outputs, metrics, var_list, tangents):
+    # J^T M J v for outputs with a diagonal Fisher metric M, J v is taken as the derivative of a
+    # vector-Jacobian product with respect to its dummy cotangents
+    dummies = [tf.zeros_like(output) for output in outputs]
+    grads = tf.gradients(outputs, var_list, grad_ys=dummies)
+    pairs = [(grad, tangent) for grad, tangent in zip(grads, tangents) if grad is not None]
+    jvps = tf.gradients([grad for grad, _ in pairs], dummies, grad_ys=[tangent for _, tangent in pairs])
+    weighted = [tf.stop_gradient(metric) * (jvp if jvp is not None else tf.zeros_like(output))
+                for output, metric, jvp in zip(outputs, metrics, jvps)]
+    grads = tf.gradients(outputs, var_list, grad_ys=weighted)
+    return tf.concat([tf.reshape(grad if grad is not None else tf.zeros(var_shape(v)), [numel(v)])
+                      for (v, grad) in zip(var_list, grads)], 0)
+
+
 class SetFromFlat(object):
     def __init__(self, var_list, session):
         self.session = session
@@ -144,6 +161,129 @@ def discount(rewards, gamma, timestamps):
     return y
 
 
+def discount_paths(x, gamma, timestamps, offsets):
+    # discount over a buffer of concatenated episodes starting at offsets[:-1], all episodes step back together
+    if len(offsets) < 2:
+        return np.zeros(0)
+    x = x.squeeze()
+    g = np.append(np.power(gamma, np.diff(timestamps.squeeze())), 0)
+    ends = offsets[1:] - 1
+    lengths = np.diff(offsets)
+    g[ends] = 0
+    y = np.zeros(x.shape)
+    running = np.zeros(lengths.shape[0])
+    for step in range(np.max(lengths)):
+        active = lengths > step
+        index = ends[active] - step
+        running[active] = x[index] + g[index] * running[active]
+        y[index] = running[active]
+    return y
+
+
+def discount_batch(rewards, terminals, bootstrap_values, gamma, timestamps):
+    # n-step returns for (n_steps, n_envs) arrays, a terminal step cuts the bootstrap from the later steps;
+    # timestamps has one more row than rewards and each step is discounted by gamma ** dt like in discount,
+    # the dt of a terminal step spans an env reset and is never used
+    g = np.power(gamma, np.diff(timestamps, axis=0) * (1 - terminals))
+    returns = np.zeros_like(rewards)
+    running = bootstrap_values
+    for step in reversed(range(rewards.shape[0])):
+        running = rewards[step] + g[step] * (1 - terminals[step]) * running
+        returns[step] = running
+    return returns
+
+
+class RolloutBuffer(object):
+    def __init__(self, capacity, n_features, action_size, dist_size=0, action_dtype=np.float32):
+        # struct of arrays for all episodes of a worker, filled in place and shipped as one record
+        self.observations = np.zeros((capacity, n_features), dtype=np.float32)
+        self.actions = np.zeros((capacity, action_size), dtype=action_dtype)
+        self.dists = np.zeros((capacity, dist_size), dtype=np.float32)
+        self.rewards = np.zeros(capacity, dtype=np.float32)
+        self.timestamps = np.zeros(capacity, dtype=np.float32)
+        self.offsets = [0]
+        self.terminated = []
+        self.totals = []
+        self.size = 0
+
+    def add(self, features, actions, reward, timestamp, dist=None):
+        index = self.size
+        self.observations[index] = features[0]
+        self.actions[index] = actions
+        self.rewards[index] = reward
+        self.timestamps[index] = timestamp
+        if dist is not None:
+            start = 0
+            for part in dist:
+                part = np.ravel(part)
+                self.dists[index, start:start + part.shape[0]] = part
+                start += part.shape[0]
+        self.size += 1
+
+    def end_episode(self, terminated, total):
+        self.offsets.append(self.size)
+        self.terminated.append(terminated)
+        self.totals.append(total)
+
+    def record(self):
+        observations = self.observations[:self.size].astype(np.float64)
+        return {
+            'observations': self.observations[:self.size],
+            'actions': self.actions[:self.size],
+            'dists': self.dists[:self.size],
+            'rewards': self.rewards[:self.size],
+            'timestamps': self.timestamps[:self.size],
+            'offsets': np.array(self.offsets, dtype=np.int64),
+            'terminated': np.array(self.terminated, dtype=bool),
+            'totals': np.array(self.totals),
+            'sumobs': np.sum(observations, axis=0, keepdims=True),
+            'sumsqrobs': np.sum(np.square(observations), axis=0, keepdims=True),
+        }
+
+
+def merge_rollouts(records):
+    # episode offsets of every record are shifted by the steps of the records before it
+    merged = {key: np.concatenate([record[key] for record in records]) for key in
+              ['observations', 'actions', 'dists', 'rewards', 'timestamps', 'terminated', 'totals']}
+    starts = np.cumsum([0] + [record['rewards'].shape[0] for record in records])
+    merged['offsets'] = np.concatenate([[0]] + [record['offsets'][1:] + start
+                                                for record, start in zip(records, starts)])
+    merged['sumobs'] = np.sum([record['sumobs'] for record in records], axis=0)
+    merged['sumsqrobs'] = np.sum([record['sumsqrobs'] for record in records], axis=0)
+    merged['record_steps'] = np.array([record['rewards'].shape[0] for record in records])
+    return merged
+
+
+def minibatch_split(n, n_minibatches, epoch, holdout=0.):
+    # the held-out part is the same every epoch, the rest is reshuffled per epoch
+    order = np.random.RandomState(0).permutation(n)
+    n_holdout = int(n * holdout)
+    train = order[n_holdout:]
+    np.random.RandomState(epoch + 1).shuffle(train)
+    return np.array_split(train, n_minibatches), order[:n_holdout]
+
+
+def fit_minibatches(train_step, n_minibatches, max_epochs, holdout_loss=None, patience=1):
+    # train_step(epoch, minibatch) makes one update, epochs stop once the held-out loss
+    # has not improved for patience epochs; returns the epochs run and the time spent.
+    # holdout_loss may return None when nothing is held out, which turns early stopping off
+    start = time.time()
+    best = holdout_loss() if holdout_loss is not None else None
+    stale = 0
+    epoch = 0
+    while epoch < max_epochs and stale < patience:
+        for minibatch in range(n_minibatches):
+            train_step(epoch, minibatch)
+        epoch += 1
+        if best is not None:
+            loss = holdout_loss()
+            if loss < best:
+                best, stale = loss, 0
+            else:
+                stale += 1
+    return epoch, time.time() - start
+
+
 def linesearch(f, x, fullstep, max_kl):
     max_backtracks = 10
     loss, _ = f(x)
@@ -157,20 +297,160 @@ def linesearch(f, x, fullstep, max_kl):
     return x
 
 
-def conjugate_gradient(f_Ax, b, cg_iters=10, residual_tol=1e-10):
-    p = b.copy()
-    r = b.copy()
-    x = np.zeros_like(b)
-    rdotr = r.dot(r)
+def conjugate_gradient(f_Ax, b, cg_iters=10, residual_tol=1e-10, x0=None, preconditioner=None, relative_tol=None):
+    # x0 warm-starts the solve, preconditioner is the diagonal of an approximation of A, with relative_tol
+    # the solve stops once |r| <= relative_tol * |b|; returns the solution and the number of iterations
+    if x0 is None:
+        x = np.zeros_like(b)
+        r = b.copy()
+    else:
+        x = x0.copy()
+        r = b - f_Ax(x)
+    if relative_tol is not None:
+        residual_tol = np.square(relative_tol) * b.dot(b)
+    if r.dot(r) < residual_tol:
+        return x, 0
+    z = r / preconditioner if preconditioner is not None else r
+    p = z.copy()
+    rdotz = r.dot(z)
     for i in range(cg_iters):
-        z = f_Ax(p)
-        v = rdotr / (p.dot(z) + 1e-18)
+        Ap = f_Ax(p)
+        v = rdotz / (p.dot(Ap) + 1e-18)
         x += v * p
-        r -= v * z
-        newrdotr = r.dot(r)
-        mu = newrdotr / (rdotr + 1e-18)
-        p = r + mu * p
-        rdotr = newrdotr
-        if rdotr < residual_tol:
-            break
-    return x
+        r -= v * Ap
+        if r.dot(r) < residual_tol:
+            return x, i + 1
+        z = r / preconditioner if preconditioner is not None else r
+        newrdotz = r.dot(z)
+        mu = newrdotz / (rdotz + 1e-18)
+        p = z + mu * p
+        rdotz = newrdotz
+    return x, cg_iters
+
+
+class Adam(object):
+    def __init__(self, shapes, learning_rate, beta_1=0.9, beta_2=0.999, epsilon=1e-6, state=None):
+        # state may be given as preallocated arrays (e.g. views into shared memory), see state_shapes
+        if state is None:
+            state = [np.zeros(shape) for shape in Adam.state_shapes(shapes)]
+        self.learning_rate = learning_rate
+        self.beta_1 = beta_1
+        self.beta_2 = beta_2
+        self.epsilon = epsilon
+        self.steps = state[0]
+        self.momentum = state[1:len(shapes) + 1]
+        self.velocity = state[len(shapes) + 1:]
+
+    @staticmethod
+    def state_shapes(shapes):
+        return [(1,)] + list(shapes) + list(shapes)
+
+    def __call__(self, weights, gradients):
+        # updates weights in place, the gradients are descent directions of the loss
+        self.steps += 1
+        steps = self.steps[0]
+        learning_rate = self.learning_rate * ((1 - self.beta_2 ** steps) ** 0.5) / (1 - self.beta_1 ** steps)
+        for weight, gradient, momentum, velocity in zip(weights, gradients, self.momentum, self.velocity):
+            momentum *= self.beta_1
+            momentum += (1 - self.beta_1) * gradient
+            velocity *= self.beta_2
+            velocity += (1 - self.beta_2) * gradient * gradient
+            weight -= momentum * learning_rate / ((velocity ** 0.5) + self.epsilon)
+        return int(steps)
+
+
+def compress_gradients(gradients, residuals, method, fraction=0.01):
+    # error feedback: whatever the compression drops is kept in residuals and added to the next push
+    compressed = []
+    for i, gradient in enumerate(gradients):
+        gradient = gradient + residuals[i]
+        if method == 'float16':
+            values = gradient.astype(np.float16)
+            residuals[i] = gradient - values
+            compressed.append(values)
+        elif method == 'topk':
+            flat = gradient.reshape(-1)
+            k = max(1, int(flat.shape[0] * fraction))
+            indices = np.argpartition(np.abs(flat), -k)[-k:].astype(np.int32)
+            values = flat[indices]
+            residual = flat.copy()
+            residual[indices] = 0
+            residuals[i] = residual.reshape(gradient.shape)
+            compressed.append((indices, values))
+        else:
+            raise Exception
+    return compressed
+
+
+def decompress_gradients(compressed, shapes):
+    gradients = []
+    for item, shape in zip(compressed, shapes):
+        if isinstance(item, tuple):
+            indices, values = item
+            gradient = np.zeros(int(np.prod(shape)), dtype=np.float32)
+            gradient[indices] = values
+            gradients.append(gradient.reshape(shape))
+        else:
+            gradients.append(np.asarray(item, dtype=np.float32))
+    return gradients
+
+
+def shared_arrays(name, shapes, mode='r+', dtype=np.float32):
+    # maps one file-backed segment (in /dev/shm when available) as a list of arrays of given shapes,
+    # mode='w+' creates (and zeroes) the segment, 'r+' and 'r' map an existing one
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    sizes = [int(np.prod(shape)) for shape in shapes]
+    path = os.path.join(directory, name)
+    segment = np.memmap(path, dtype=dtype, mode=mode, shape=(sum(sizes),))
+    if mode == 'w+':
+        # the process that creates a segment owns it and removes it when it exits
+        atexit.register(remove_segment, path)
+    arrays = []
+    start = 0
+    for shape, size in zip(shapes, sizes):
+        arrays.append(segment[start:start + size].reshape(shape))
+        start += size
+    return arrays
+
+
+def remove_segment(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def unflatten(flat, shapes):
+    arrays = []
+    start = 0
+    for shape in shapes:
+        size = int(np.prod(shape))
+        arrays.append(flat[start:start + size].reshape(shape))
+        start += size
+    return arrays
+
+
+class NoiseTable(object):
+    def __init__(self, name, size, seed=None, chunk_size=2 ** 20):
+        # with a seed the table is generated into a new shared segment, otherwise the existing one is mapped read-only
+        if seed is None:
+            self.noise = shared_arrays(name, [(size,)], mode='r')[0]
+        else:
+            self.noise = shared_arrays(name, [(size,)], mode='w+')[0]
+            random_state = np.random.RandomState(seed)
+            for start in range(0, size, chunk_size):
+                self.noise[start:start + chunk_size] = random_state.randn(min(chunk_size, size - start))
+            self.noise.flush()
+
+    def get(self, offset, size):
+        return self.noise[offset:offset + size]
+
+    def sample_offsets(self, random_state, size, n):
+        return random_state.randint(0, self.noise.shape[0] - size + 1, size=n)
+
+    def weighted_sum(self, offsets, coefficients, size, chunk_size=256, dtype=np.float32):
+        # sum of coefficients[i] * noise[offsets[i]:offsets[i] + size] as chunked matrix-vector products
+        total = np.zeros(size, dtype=dtype)
+        coefficients = np.asarray(coefficients, dtype=dtype)
+        for start in range(0, len(offsets), chunk_size):
+            block = np.stack([self.get(offset, size) for offset in offsets[start:start + chunk_size]])
+            total += np.dot(coefficients[start:start + chunk_size], block.astype(dtype, copy=False))
+        return total
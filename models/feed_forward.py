@@ -5,7 +5,7 @@ import sys
 
 sys.path.append(os.path.realpath(".."))
 
-from helpers.layers import denselayer
+from helpers.layers import denselayer, population_denselayer
 from models.base_model import BaseModel
 import numpy as np
 
@@ -33,6 +33,8 @@ class FeedForward(BaseModel):
         std_ph = tf.placeholder(tf.float32, shape=std.get_shape())
         self.norm_set_op = [mean.assign(mean_ph), std.assign(std_ph)]
         self.norm_phs = [mean_ph, std_ph]
+        self.feature_means = mean
+        self.feature_stds = std
         hidden = (input - mean) / (std + 1e-5)
         hidden = tf.clip_by_value(hidden, -20, 20)
         self.hidden = hidden
@@ -48,6 +50,109 @@ class FeedForward(BaseModel):
         self.value = tf.reshape(self.value, [-1])
         self.value_weights += weights
         self.value_weights_phs += [tf.placeholder(tf.float32, shape=w.get_shape()) for w in weights]
+        for weight, ph in zip(weights, self.value_weights_phs):
+            self.value_set_op.append(weight.assign(ph))
+
+    def get_value_weights(self):
+        return self.sess.run(self.value_weights)
+
+    def set_value_weights(self, new_weights):
+        self.sess.run(self.value_set_op, feed_dict=dict(zip(self.value_weights_phs, new_weights)))
+
+    def create_population(self, population):
+        # stacked copy of the policy weights, so that one session call evaluates a different policy per input row
+        self.population = population
+        self.population_input = tf.placeholder(tf.float32, shape=(population, self.n_features))
+        self.population_weights = []
+        self.population_phs = []
+        with tf.variable_scope("population"):
+            for index, weight in enumerate(self.weights):
+                shape = [population] + weight.get_shape().as_list()
+                self.population_weights.append(tf.get_variable("weight_{}".format(index), shape=shape,
+                                                               trainable=False))
+                self.population_phs.append(tf.placeholder(tf.float32, shape=shape))
+        self.population_set_op = [w.assign(ph) for w, ph in zip(self.population_weights, self.population_phs)]
+
+        hidden = (self.population_input - self.feature_means) / (self.feature_stds + 1e-5)
+        hidden = tf.clip_by_value(hidden, -20, 20)
+        for index in range(len(self.n_hiddens)):
+            hidden = population_denselayer(hidden, self.population_weights[2 * index],
+                                           self.population_weights[2 * index + 1], self.nonlinearity)
+        self.create_population_output(hidden, self.population_weights[2 * len(self.n_hiddens):])
+        self.sess.run(tf.variables_initializer(self.population_weights))
+
+    def create_perturbation(self, rank=None, layers=None):
+        # keeps a resident copy of the weights, so a perturbed policy is one assign and restoring it needs no feed;
+        # with a rank 2-d weights take the factorized noise a * b / sqrt(rank), with layers only those scopes move
+        shapes = [weight.get_shape().as_list() for weight in self.weights]
+        self.perturbation_shapes = shapes
+        self.perturbation_rank = rank
+        self.perturbation_layout = []
+        for weight, shape in zip(self.weights, shapes):
+            scope = weight.name.split('/')[0].split(':')[0]
+            if layers is not None and scope not in layers:
+                self.perturbation_layout.append(('off', 0))
+            elif rank is not None and len(shape) == 2 and rank * (shape[0] + shape[1]) < shape[0] * shape[1]:
+                self.perturbation_layout.append(('lowrank', rank * (shape[0] + shape[1])))
+            else:
+                self.perturbation_layout.append(('full', int(np.prod(shape))))
+        self.noise_size = sum(size for _, size in self.perturbation_layout)
+        self.perturbation_noise = tf.placeholder(tf.float32, shape=[self.noise_size])
+        self.perturbation_scale = tf.placeholder(tf.float32, shape=[])
+        self.base_weights = []
+        with tf.variable_scope("perturbation"):
+            for index, shape in enumerate(shapes):
+                self.base_weights.append(tf.get_variable("base_{}".format(index), shape=shape, trainable=False))
+        perturb_op = []
+        start = 0
+        for weight, base, shape, (kind, size) in zip(self.weights, self.base_weights, shapes,
+                                                     self.perturbation_layout):
+            noise = self.perturbation_noise[start:start + size]
+            start += size
+            if kind == 'off':
+                continue
+            if kind == 'lowrank':
+                noise = tf.matmul(tf.reshape(noise[:shape[0] * rank], [shape[0], rank]),
+                                  tf.reshape(noise[shape[0] * rank:], [rank, shape[1]])) / np.sqrt(rank)
+            else:
+                noise = tf.reshape(noise, shape)
+            perturb_op.append(weight.assign(base + self.perturbation_scale * noise))
+        self.perturb_op = tf.group(*perturb_op)
+        self.store_base_op = tf.group(*[base.assign(weight) for weight, base in zip(self.weights, self.base_weights)])
+        self.restore_base_op = tf.group(*[weight.assign(base) for weight, base in zip(self.weights, self.base_weights)])
+        self.sess.run(tf.variables_initializer(self.base_weights))
+
+    def perturb_weights(self, noise, scale):
+        self.sess.run(self.perturb_op, feed_dict={self.perturbation_noise: noise, self.perturbation_scale: scale})
+
+    def expand_noise(self, noises, coefficients=None):
+        # maps compact noise rows [n, noise_size] to flat perturbations [n, n_params], or with coefficients
+        # straight to their weighted sum, so low-rank factors are never expanded one by one
+        rank = self.perturbation_rank
+        parts = []
+        start = 0
+        for shape, (kind, size) in zip(self.perturbation_shapes, self.perturbation_layout):
+            noise = noises[:, start:start + size]
+            start += size
+            if kind == 'lowrank':
+                a = noise[:, :shape[0] * rank].reshape((-1, shape[0], rank))
+                b = noise[:, shape[0] * rank:].reshape((-1, rank, shape[1]))
+                if coefficients is None:
+                    part = np.matmul(a, b).reshape((noises.shape[0], -1))
+                else:
+                    a = np.transpose(a * coefficients[:, None, None], (1, 0, 2)).reshape((shape[0], -1))
+                    part = np.dot(a, b.reshape((-1, shape[1]))).reshape(-1)
+                part /= np.sqrt(rank)
+            elif kind == 'full':
+                part = noise if coefficients is None else np.dot(coefficients, noise)
+            else:
+                size = int(np.prod(shape))
+                part = np.zeros((noises.shape[0], size) if coefficients is None else size, dtype=noises.dtype)
+            parts.append(part)
+        return np.concatenate(parts, axis=-1)
+
+    def set_population_weights(self, new_weights):
+        self.sess.run(self.population_set_op, feed_dict=dict(zip(self.population_phs, new_weights)))
 
 
 class FFDiscrete(FeedForward):
@@ -82,6 +187,31 @@ class FFDiscrete(FeedForward):
             return actions, log_probs
         return actions
 
+    def create_population_output(self, hidden, weights):
+        self.population_logprobs = []
+        for index in range(len(self.n_actions)):
+            self.population_logprobs.append(population_denselayer(hidden, weights[2 * index], weights[2 * index + 1],
+                                                                   tf.nn.log_softmax))
+
+    def act_population(self, obs):
+        log_probs = self.sess.run(self.population_logprobs, feed_dict={self.population_input: obs})
+        return self.sample_actions(log_probs)
+
+    def act_batch(self, obs, exploration=True):
+        log_probs = self.sess.run(self.action_logprobs, feed_dict={self.state_input: obs})
+        return self.sample_actions(log_probs, exploration)
+
+    def sample_actions(self, log_probs, exploration=True):
+        actions = np.zeros(shape=(log_probs[0].shape[0], len(log_probs)), dtype=np.int32)
+        for i in range(len(log_probs)):
+            if not exploration:
+                actions[:, i] = np.argmax(log_probs[i], axis=1)
+                continue
+            cumulative = np.cumsum(np.exp(log_probs[i]), axis=1)
+            uniforms = np.random.uniform(size=(log_probs[i].shape[0], 1))
+            actions[:, i] = np.minimum(np.sum(cumulative < uniforms, axis=1), self.n_actions[i] - 1)
+        return actions
+
 
 class FFContinuous(FeedForward):
     def __init__(self, sess, args):
@@ -132,3 +262,23 @@ class FFContinuous(FeedForward):
         if return_dists:
             return actions, [means, stds]
         return actions
+
+    def act_batch(self, obs, exploration=True):
+        means, stds = self.sess.run([self.action_means, self.action_stds], feed_dict={self.state_input: obs})
+        if not exploration:
+            return means
+        return np.random.normal(means, stds)
+
+    def create_population_output(self, hidden, weights):
+        self.population_means = population_denselayer(hidden, weights[0], weights[1])
+        if self.std == "Const":
+            self.population_stds = tf.tile(self.action_stds, [self.population, 1])
+        elif self.std == "Param":
+            self.population_stds = tf.exp(tf.reshape(weights[2], [self.population, -1]))
+        else:
+            self.population_stds = population_denselayer(hidden, weights[2], weights[3], tf.exp)
+
+    def act_population(self, obs):
+        means, stds = self.sess.run([self.population_means, self.population_stds],
+                                    feed_dict={self.population_input: obs})
+        return np.random.normal(means, stds)
@@ -11,6 +11,7 @@ tf.app.flags.DEFINE_integer("id_worker", 0, "Index of task within the job")
 tf.app.flags.DEFINE_boolean("test_mode", False, "Index of task within the job")
 tf.app.flags.DEFINE_string("command", 'train', "What the agent should do")
 tf.app.flags.DEFINE_integer("start_iteration", -1, "What checkpoint should we use as 'warm start'")
+tf.app.flags.DEFINE_string("run_id", '', "Id of the master run, workers get it to find its shared segments")
 
 FLAGS = tf.app.flags.FLAGS
 
@@ -29,6 +30,7 @@ config['n_actions'] = env.get_action_space()
 
 config['id_worker'] = FLAGS.id_worker
 config['test_mode'] = FLAGS.test_mode
+config['run_id'] = FLAGS.run_id or str(os.getpid())
 
 agent = algo(sess, config)
 if FLAGS.start_iteration >= 0: